@@ -1,4 +1,62 @@
+import os
+import random
+
+# Appstats records 1 in every 1/APPSTATS_SAMPLE_RATE requests; endpoints
+# listed in APPSTATS_ENDPOINT_RATES (by method name, e.g. 'queryConferences')
+# use their own rate instead. Admins can force recording of one request
+# with an 'X-Appstats: 1' header or an 'appstats=1' cookie.
+APPSTATS_SAMPLE_RATE = 0.01
+APPSTATS_ENDPOINT_RATES = {}
+APPSTATS_OPT_IN_HEADER = 'HTTP_X_APPSTATS'
+APPSTATS_OPT_IN_COOKIE = 'appstats=1'
+
+# lightweight mode: record RPC timings only, without stack traces or
+# per-RPC datastore cost/detail lookups
+APPSTATS_LIGHTWEIGHT = True
+
+if APPSTATS_LIGHTWEIGHT:
+    appstats_MAX_STACK = 0
+    appstats_CALC_RPC_COSTS = False
+    appstats_DATASTORE_DETAILS = False
+
+
+def _endpointName(env):
+    """Method name for endpoint calls, path for everything else."""
+    path = env.get('PATH_INFO', '')
+    # endpoints calls arrive as /_ah/spi/ConferenceApi.getConference
+    if path.startswith('/_ah/spi/'):
+        return path.rsplit('.', 1)[-1]
+    return path
+
+
+def _optedIn(env):
+    """True for admin requests that asked to be recorded."""
+    if (env.get(APPSTATS_OPT_IN_HEADER) != '1' and
+            APPSTATS_OPT_IN_COOKIE not in env.get('HTTP_COOKIE', '')):
+        return False
+    from google.appengine.api import users
+    return users.is_current_user_admin()
+
+
+def appstats_should_record(env):
+    if _optedIn(env):
+        return True
+    rate = APPSTATS_ENDPOINT_RATES.get(_endpointName(env),
+                                       APPSTATS_SAMPLE_RATE)
+    return random.random() < rate
+
+
+def namespace_manager_default_namespace_for_request():
+    # one namespace per tenant (see tenants.py); '' without tenants
+    from tenants import tenantForEnviron
+    return tenantForEnviron(os.environ)
+
+
 def webapp_add_wsgi_middleware(app):
     from google.appengine.ext.appstats import recording
+    from profiler import profiling_wsgi_middleware
+    from tenants import tenant_path_middleware
+    app = tenant_path_middleware(app)
+    app = profiling_wsgi_middleware(app)
     app = recording.appstats_wsgi_middleware(app)
-    return app
\ No newline at end of file
+    return app
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py -- Udacity conference server-side Python App Engine
+    endpoint benchmarks against the App Engine testbed stubs
+
+Drives every ConferenceApi method against datastore, memcache, taskqueue
+and urlfetch stubs loaded with synthetic fixtures, and records wall time,
+CPU time, RPC counts and datastore write ops (entity and index rows) per
+endpoint to a JSON baseline:
+
+    python benchmark.py --sdk ~/google_appengine --sizes 1000,10000 \\
+        --output baseline.json [--compare old_baseline.json]
+
+With --check-budgets it also fails (exit status 1) when any method raises
+or makes more RPCs than RPC_BUDGETS allows, which catches N+1 query
+patterns.
+
+Not deployed (see skip_files in app.yaml).
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date
+from datetime import time as dtime
+
+SIZES = (1000, 10000, 100000)
+REPEATS = 3
+FIXTURE_BATCH_SIZE = 500
+SESSIONS_PER_CONFERENCE = 1
+CONFERENCES_PER_ORGANIZER = 20
+
+CITIES = ['London', 'Paris', 'Chicago', 'Tokyo', 'Berlin',
+          'Toronto', 'Sydney', 'Madrid', 'Austin', 'Dublin']
+TOPICS = ['Web', 'Mobile', 'Cloud', 'Data', 'Security', 'Design']
+TYPES = ['lecture', 'workshop', 'keynote', 'panel']
+HIGHLIGHTS = ['python', 'ndb', 'endpoints', 'memcache', 'angular']
+BENCH_USER = 'bench@example.com'
+
+# Most RPCs, per service, one call of a method may make at *any* fixture
+# size. datastore_v3.Next only pages further through a query that is
+# already counted, so it is left out; everything else (a Get per row,
+# a query per row...) shows up as a budget overrun as the fixtures grow.
+UNBUDGETED_CALLS = ('datastore_v3.Next',)
+RPC_BUDGETS = {
+    'getProfile':                          {'datastore_v3': 2},
+    'saveProfile':                         {'datastore_v3': 2},
+    'createConference':                    {'datastore_v3': 2, 'taskqueue': 2},
+    'updateConference':                    {'datastore_v3': 5, 'taskqueue': 1},
+    'getConference':                       {'datastore_v3': 1},
+    'getConferencesCreated':               {'datastore_v3': 2},
+    'queryConferences':                    {'datastore_v3': 2},
+    'registerForConference':               {'datastore_v3': 5, 'taskqueue': 1},
+    'getConferencesToAttend':              {'datastore_v3': 3},
+    'getConferenceAttendees':              {'datastore_v3': 1},
+    'unregisterFromConference':            {'datastore_v3': 5, 'taskqueue': 1},
+    'createSession':                       {'datastore_v3': 2, 'taskqueue': 1},
+    'getConferenceSessions':               {'datastore_v3': 2},
+    'getConferenceSessionsByType':         {'datastore_v3': 2},
+    'getSessionsBySpeaker':                {'datastore_v3': 1},
+    'getConferenceSessionsByHighlight':    {'datastore_v3': 1},
+    'getConferencesWithSessionHighlights': {'datastore_v3': 3},
+    'getConferenceSessionsByFilters':      {'datastore_v3': 1},
+    'addSessionToWishlist':                {'datastore_v3': 4},
+    'getSessionsInWishlist':               {'datastore_v3': 2},
+    'getChangesSince':                     {'datastore_v3': 4},
+    'getAnnouncement':                     {'datastore_v3': 0, 'memcache': 1},
+    'getConferenceFacets':                 {'datastore_v3': 1, 'memcache': 2},
+    'getFeaturedSpeaker':                  {'datastore_v3': 0, 'memcache': 2},
+}
+
+
+def _setupSdk(sdk_path):
+    """Put the App Engine SDK and this app on sys.path."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _activateTestbed():
+    """Activate the service stubs and sign in the benchmark user."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    tb.init_urlfetch_stub()
+    tb.init_user_stub()
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = BENCH_USER
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+    return tb
+
+
+def loadFixtures(size):
+    """Write `size` conferences and sessions; return handles for requests."""
+    from google.appengine.ext import ndb
+    from models import Conference, ConferenceSession, Profile, Speaker
+
+    rnd = random.Random(size)
+    organizers = [BENCH_USER] + ['organizer%d@example.com' % i for i in
+                                 xrange(size / CONFERENCES_PER_ORGANIZER)]
+    profiles = [Profile(key=ndb.Key(Profile, email), displayName=email,
+                        mainEmail=email) for email in organizers]
+    _putBatches(profiles)
+
+    conf_keys = []
+    batch = []
+    for i in xrange(size):
+        # conference 0 is the one registered for, so it needs free seats
+        max_attendees = 500 if i == 0 else rnd.choice([0, 50, 100, 500])
+        p_key = ndb.Key(Profile, organizers[i % len(organizers)])
+        conf = Conference(
+            parent=p_key,
+            name='Conference %d' % i,
+            description='Synthetic benchmark conference %d' % i,
+            organizerUserId=p_key.id(),
+            topics=rnd.sample(TOPICS, 2),
+            city=rnd.choice(CITIES),
+            startDate=date(2016, rnd.randint(1, 12), rnd.randint(1, 28)),
+            endDate=date(2016, 12, 31),
+            maxAttendees=max_attendees,
+            seatsAvailable=rnd.randint(i == 0, max_attendees))
+        batch.append(conf)
+        if len(batch) == FIXTURE_BATCH_SIZE:
+            conf_keys.extend(_putBatches(batch))
+            batch = []
+    conf_keys.extend(_putBatches(batch))
+
+    speakers = ['Speaker %d' % i for i in xrange(max(1, size / 10))]
+    batch = []
+    for i in xrange(size * SESSIONS_PER_CONFERENCE):
+        batch.append(ConferenceSession(
+            parent=conf_keys[i % len(conf_keys)],
+            name='Session %d' % i,
+            speakers=[Speaker(name=rnd.choice(speakers))],
+            highlights=rnd.sample(HIGHLIGHTS, 2),
+            date=date(2016, 6, 1),
+            start_time=dtime(rnd.randint(8, 18), rnd.choice([0, 30])),
+            duration_in_minutes=rnd.choice([30, 45, 60]),
+            type=rnd.choice(TYPES),
+            description='Synthetic benchmark session %d. ' % i * 20))
+        if len(batch) == FIXTURE_BATCH_SIZE:
+            _putBatches(batch)
+            batch = []
+    _putBatches(batch)
+
+    session = ConferenceSession.query(ancestor=conf_keys[0]).get()
+    return {'conference': conf_keys[0].urlsafe(),
+            'session': session.key.urlsafe(),
+            'speaker': session.speakers[0].name,
+            'highlight': session.highlights[0],
+            'type': session.type}
+
+
+def _putBatches(entities):
+    from google.appengine.ext import ndb
+    return ndb.put_multi(entities, use_cache=False, use_memcache=False)
+
+
+def benchmarkRequests(fx):
+    """Return [(method name, request factory)], in call order."""
+    import conference as c
+    from protorpc import message_types
+    from models import (ConferenceForm, ConferenceQueryForm,
+                        ConferenceQueryForms, ConferenceSessionForm,
+                        ProfileMiniForm, SessionWishlistForm)
+
+    void = message_types.VoidMessage
+    conf_get = lambda: c.CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=fx['conference'])
+    listing = c.LIST_GET_REQUEST.combined_message_class
+    return [
+        ('getProfile', void),
+        ('saveProfile', lambda: ProfileMiniForm(displayName='Bench')),
+        ('createConference', lambda: ConferenceForm(
+            name='Bench conference', city='London', maxAttendees=10,
+            startDate='2016-05-01', endDate='2016-05-02')),
+        ('updateConference', lambda: c.CONF_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=fx['conference'], city='Paris')),
+        ('getConference', conf_get),
+        ('getConferencesCreated', listing),
+        ('queryConferences', lambda: ConferenceQueryForms()),
+        ('queryConferences', lambda: ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field='CITY', operator='EQ', value='London'),
+            ConferenceQueryForm(field='MONTH', operator='GT', value='6')])),
+        ('registerForConference', conf_get),
+        ('getConferenceAttendees', lambda:
+            c.ATTENDEES_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=fx['conference'], pageSize=100)),
+        ('getConferencesToAttend', listing),
+        ('unregisterFromConference', conf_get),
+        ('createSession', lambda: ConferenceSessionForm(
+            name='Bench session', speakers=[fx['speaker']],
+            highlights=[fx['highlight']], date='2016-06-01',
+            start_time='10:00', duration_in_minutes=30, type='lecture',
+            parent_key=fx['conference'])),
+        ('getConferenceSessions', lambda:
+            c.CONF_SESS_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=fx['conference'])),
+        ('getConferenceSessionsByType', lambda:
+            c.TYPE_SESS_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=fx['conference'],
+                websafeType=fx['type'])),
+        ('getSessionsBySpeaker', lambda:
+            c.SPEAKER_SESS_GET_REQUEST.combined_message_class(
+                websafeSpeaker=fx['speaker'])),
+        ('getConferenceSessionsByHighlight', lambda:
+            c.HIGHLIGHT_SESS_GET_REQUEST.combined_message_class(
+                websafeHighlight=fx['highlight'])),
+        ('getConferencesWithSessionHighlights', lambda:
+            c.HIGHLIGHT_SESS_GET_REQUEST.combined_message_class(
+                websafeHighlight=fx['highlight'])),
+        ('getConferenceSessionsByFilters', lambda:
+            c.TYPE_TIME_GET_REQUEST.combined_message_class(
+                websafeType=fx['type'], websafeTime='12:00',
+                websafeOperator='<')),
+        ('addSessionToWishlist', lambda: SessionWishlistForm(
+            session_key=fx['session'])),
+        ('getSessionsInWishlist', listing),
+        ('getChangesSince', lambda:
+            c.SYNC_GET_REQUEST.combined_message_class()),
+        ('getAnnouncement', void),
+        ('getConferenceFacets', void),
+        ('getFeaturedSpeaker', void),
+    ]
+
+
+def runBenchmarks(size, repeats=REPEATS):
+    """Time every endpoint at one fixture size; return {label: result}."""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    from conference import ConferenceApi
+    from rpcstats import RpcStats
+
+    fx = loadFixtures(size)
+    api = ConferenceApi()
+    requests = benchmarkRequests(fx)
+
+    missing = set(ConferenceApi.all_remote_methods()) - set(
+        name for name, _ in requests)
+    if missing:
+        print >> sys.stderr, 'not benchmarked: %s' % ', '.join(sorted(missing))
+
+    samples = {}
+    for _ in xrange(repeats):
+        for i, (name, factory) in enumerate(requests):
+            # start every call cold, like a fresh request on a new instance
+            ndb.get_context().clear_cache()
+            memcache.flush_all()
+            request = factory()
+            error = None
+            wall, cpu = time.time(), time.clock()
+            with RpcStats() as stats:
+                try:
+                    getattr(api, name)(request)
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+            wall, cpu = time.time() - wall, time.clock() - cpu
+            label = '%02d_%s' % (i, name)
+            samples.setdefault(label, []).append(
+                (wall, cpu, stats.toDict(), error))
+
+    results = {}
+    for label, runs in samples.iteritems():
+        runs.sort(key=lambda r: r[0])
+        wall, cpu, rpcs, _ = runs[len(runs) / 2]     # median by wall
+        errors = [r[3] for r in runs if r[3]]
+        results[label] = {'wall_ms': round(wall * 1000, 2),
+                          'cpu_ms': round(cpu * 1000, 2),
+                          'rpcs': rpcs['services'],
+                          'calls': rpcs['calls'],
+                          'write_ops': rpcs['writeOps']}
+        if errors:
+            results[label]['error'] = errors[0]
+    return results
+
+
+def budgetViolations(results):
+    """Return a message for every call that failed or went over budget."""
+    violations = []
+    for size in sorted(results, key=int):
+        for label in sorted(results[size]):
+            name = label.split('_', 1)[1]
+            # a call that fails early makes fewer RPCs; never let it pass
+            if results[size][label].get('error'):
+                violations.append('%s at %s failed: %s' % (
+                    name, size, results[size][label]['error']))
+            used = {}
+            for call, count in results[size][label]['calls'].iteritems():
+                if call not in UNBUDGETED_CALLS:
+                    service = call.split('.')[0]
+                    used[service] = used.get(service, 0) + count
+            for service, budget in sorted(RPC_BUDGETS.get(name, {}).items()):
+                if used.get(service, 0) > budget:
+                    violations.append('%s at %s: %d %s RPCs (budget %d)' % (
+                        name, size, used[service], service, budget))
+    unbudgeted = set(label.split('_', 1)[1] for size in results
+                     for label in results[size]) - set(RPC_BUDGETS)
+    violations.extend('%s has no RPC budget' % name
+                      for name in sorted(unbudgeted))
+    return violations
+
+
+def compare(baseline, current):
+    """Print per-endpoint changes against an older baseline."""
+    for size in sorted(current, key=int):
+        for label in sorted(current[size]):
+            old = baseline.get(size, {}).get(label)
+            new = current[size][label]
+            if not old:
+                continue
+            print ('%7s %-42s wall %8.1f -> %8.1fms  rpcs %4d -> %4d  '
+                   'index writes %4d -> %4d' % (
+                       size, label, old['wall_ms'], new['wall_ms'],
+                       sum(old['rpcs'].values()), sum(new['rpcs'].values()),
+                       old.get('write_ops', {}).get('index_writes', 0),
+                       new.get('write_ops', {}).get('index_writes', 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the google_appengine SDK')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)))
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--output', default='benchmark_baseline.json')
+    parser.add_argument('--compare', help='older baseline to diff against')
+    parser.add_argument('--check-budgets', action='store_true',
+                        help='exit non-zero if any method exceeds '
+                             'its RPC budget')
+    args = parser.parse_args()
+
+    _setupSdk(args.sdk)
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        tb = _activateTestbed()
+        try:
+            results[str(size)] = runBenchmarks(size, args.repeats)
+        finally:
+            tb.deactivate()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.check_budgets:
+        violations = budgetViolations(results)
+        for violation in violations:
+            print >> sys.stderr, 'RPC budget check failed: %s' % violation
+        sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
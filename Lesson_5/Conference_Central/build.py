@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+build.py -- Udacity conference server-side Python App Engine
+    static asset bundle for the Angular frontend
+
+Writes static/dist/ (served by app.yaml; run before dev_appserver.py or
+deploying):
+
+    app.<md5>.js    static/js/*.js plus every static/partials/*.html
+                    preloaded into Angular's $templateCache
+    app.<md5>.css   the local stylesheets
+    index.html      templates/index.html with the <!-- build:js/css -->
+                    blocks pointing at the fingerprinted bundles
+
+Bundles are minified when the optional rjsmin/rcssmin packages are
+installed, and only concatenated otherwise. Not deployed (see skip_files
+in app.yaml).
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DIST = os.path.join(ROOT, 'static', 'dist')
+JS_SOURCES = ['static/js/app.js', 'static/js/controllers.js']
+CSS_SOURCES = ['static/bootstrap/css/bootstrap-cosmo.css',
+               'static/bootstrap/css/main.css',
+               'static/bootstrap/css/offcanvas.css']
+PARTIALS = 'static/partials/*.html'
+INDEX = 'templates/index.html'
+BUILD_BLOCK = re.compile(
+    r'<!-- build:(js|css) -->.*?<!-- endbuild -->', re.S)
+
+
+def _read(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return f.read()
+
+
+def templateCacheModule():
+    """Return JS that preloads every partial into $templateCache."""
+    puts = []
+    for path in sorted(glob.glob(os.path.join(ROOT, PARTIALS))):
+        url = '/partials/' + os.path.basename(path)
+        with open(path) as f:
+            puts.append('    $templateCache.put(%s, %s);' % (
+                json.dumps(url), json.dumps(f.read())))
+    return ("angular.module('conferenceApp').run(['$templateCache', "
+            "function ($templateCache) {\n%s\n}]);\n" % '\n'.join(puts))
+
+
+def _write(name, ext, content):
+    """Write content to dist under a content-hash name; return its URL."""
+    digest = hashlib.md5(content).hexdigest()[:12]
+    filename = '%s.%s.%s' % (name, digest, ext)
+    with open(os.path.join(DIST, filename), 'w') as f:
+        f.write(content)
+    return '/dist/' + filename
+
+
+def build():
+    if os.path.isdir(DIST):
+        shutil.rmtree(DIST)
+    os.makedirs(DIST)
+
+    js = ';\n'.join([_read(p) for p in JS_SOURCES] + [templateCacheModule()])
+    if rjsmin:
+        js = rjsmin.jsmin(js)
+    css = '\n'.join(_read(p) for p in CSS_SOURCES)
+    if rcssmin:
+        css = rcssmin.cssmin(css)
+
+    urls = {'js': _write('app', 'js', js), 'css': _write('app', 'css', css)}
+    tags = {'js': '<script src="%s"></script>',
+            'css': '<link rel="stylesheet" href="%s">'}
+    index = BUILD_BLOCK.sub(
+        lambda m: tags[m.group(1)] % urls[m.group(1)], _read(INDEX))
+    with open(os.path.join(DIST, 'index.html'), 'w') as f:
+        f.write(index)
+
+    if not (rjsmin and rcssmin):
+        print 'rjsmin/rcssmin not installed: bundles are not minified'
+    print 'built %s and %s' % (urls['js'], urls['css'])
+
+
+if __name__ == '__main__':
+    build()
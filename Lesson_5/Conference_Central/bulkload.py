@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""
+bulkload.py -- Udacity conference server-side Python App Engine
+    bulk import of conferences and sessions from NDJSON
+
+Each input line is a JSON object with a '_kind' of 'Conference' or
+'ConferenceSession' (the format written by export.py). Lines carrying a
+'_key' keep that key; new conferences get ids allocated in one block per
+organizer and may name themselves with a '_ref' that sessions point at
+through '_conference' (a '_ref' or a urlsafe conference key).
+
+startImport() stores the input as ImportChunk entities of about
+IMPORT_CHUNK_BYTES under an ImportStatus, and a chain of tasks (see
+taskchain.py) imports them one chunk per task. The chain walks the chunks
+twice: first writing conferences, then sessions, so every session's
+parent exists and '_ref's from any chunk resolve. Ids for new entities
+are allocated once per chunk and stored with it, so a retried task
+rewrites the same entities, and its tasks are named so they are not
+queued twice. After the last chunk the announcement is refreshed and
+the chunks are deleted.
+
+"""
+
+import json
+import time
+import uuid
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from conference import DEFAULTS
+from models import Conference
+from models import ConferenceSession
+from models import ImportChunk
+from models import ImportStatus
+from models import Profile
+from models import Speaker
+from taskchain import chainBatch
+from taskchain import checkpoint
+from taskchain import pageCursor
+from taskchain import runBatch
+from tenants import taskName
+
+# datastore limit on entities per put RPC / tasks per queue add RPC
+PUT_BATCH_SIZE = 500
+TASK_BATCH_SIZE = 100
+
+BULK_PUT_OPTIONS = {'use_cache': False, 'use_memcache': False}
+
+IMPORT_URL = '/tasks/bulk_import'
+# raw NDJSON per stored chunk, i.e. per import task
+IMPORT_CHUNK_BYTES = 512 * 1024
+# chunks per put RPC, keeping it well under the RPC size limit
+IMPORT_CHUNK_PUT = 8
+
+
+def _modelData(model, line):
+    """Keep only the stored (non-computed) properties of a model.
+
+    An exported 'created' is kept (auto_now_add leaves a set value
+    alone); 'updated' is dropped, since every put sets it.
+    """
+    data = dict((name, value) for name, value in line.iteritems()
+                if name in model._properties and name != 'updated' and
+                not isinstance(model._properties[name], ndb.ComputedProperty))
+    created = data.pop('created', None)
+    if created:
+        data['created'] = datetime.strptime(created[:19], '%Y-%m-%dT%H:%M:%S')
+    return data
+
+
+def _conferenceFromLine(line, key):
+    """Build a Conference entity from a parsed NDJSON line."""
+    data = _modelData(Conference, line)
+    for df in DEFAULTS:
+        if data.get(df) in (None, []):
+            data[df] = DEFAULTS[df]
+    for field in ('startDate', 'endDate'):
+        if data.get(field):
+            data[field] = datetime.strptime(data[field][:10], "%Y-%m-%d").date()
+    if data['maxAttendees'] > 0 and not data.get('seatsAvailable'):
+        data['seatsAvailable'] = data['maxAttendees']
+    data['organizerUserId'] = key.parent().id()
+    return Conference(key=key, **data)
+
+
+def _sessionFromLine(line, key):
+    """Build a ConferenceSession entity from a parsed NDJSON line."""
+    data = _modelData(ConferenceSession, line)
+    if data.get('start_time'):
+        data['start_time'] = datetime.strptime(
+            data['start_time'][:5], '%H:%M').time()
+    if data.get('date'):
+        data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+    # speakers come either as plain names or as exported Speaker dicts
+    data['speakers'] = [
+        Speaker(name=s['name'] if isinstance(s, dict) else s)
+        for s in data.get('speakers') or []]
+    return ConferenceSession(key=key, **data)
+
+
+def _allocateKeys(model, parents):
+    """Allocate one id block per parent; return keys in parents' order."""
+    by_parent = {}
+    for i, parent in enumerate(parents):
+        by_parent.setdefault(parent, []).append(i)
+
+    # issue every allocation RPC before waiting on any of them
+    futures = dict(
+        (parent, model.allocate_ids_async(size=len(indexes), parent=parent))
+        for parent, indexes in by_parent.iteritems())
+
+    keys = [None] * len(parents)
+    for parent, indexes in by_parent.iteritems():
+        start, _ = futures[parent].get_result()
+        for offset, i in enumerate(indexes):
+            keys[i] = ndb.Key(model, start + offset, parent=parent)
+    return keys
+
+
+def _chunkKeys(chunk, phase, model, parents):
+    """Keys for a chunk's new entities, allocated on its first run."""
+    keys = chunk.keys or {}
+    if phase not in keys:
+        keys[phase] = [k.urlsafe() for k in _allocateKeys(model, parents)]
+        chunk.keys = keys
+        chunk.put(**BULK_PUT_OPTIONS)
+    return [ndb.Key(urlsafe=k) for k in keys[phase]]
+
+
+def _putInBatches(entities):
+    """put_multi in RPC-sized batches, all batches in flight at once."""
+    futures = []
+    for i in xrange(0, len(entities), PUT_BATCH_SIZE):
+        futures.extend(ndb.put_multi_async(
+            entities[i:i + PUT_BATCH_SIZE], **BULK_PUT_OPTIONS))
+    ndb.Future.wait_all(futures)
+    return [f.get_result() for f in futures]
+
+
+def _addInBatches(tasks):
+    """Enqueue tasks TASK_BATCH_SIZE at a time; named ones only once."""
+    queue = taskqueue.Queue()
+    for i in xrange(0, len(tasks), TASK_BATCH_SIZE):
+        try:
+            queue.add(tasks[i:i + TASK_BATCH_SIZE])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass            # the rest of the batch is still added
+
+
+def _importConferences(lines, chunk, refs):
+    """Write a chunk's conferences, recording their '_ref's in refs.
+
+    Returns (conferences, lines skipped).
+    """
+    conf_lines, skipped = [], 0
+    for line in lines:
+        kind = line.get('_kind')
+        if kind == 'Conference' and (line.get('_key') or
+                                     line.get('organizerUserId')):
+            conf_lines.append(line)
+        elif kind != 'ConferenceSession':
+            skipped += 1
+
+    # keep exported keys, allocate the rest per organizer
+    new_keys = iter(_chunkKeys(chunk, 'conferences', Conference, [
+        ndb.Key(Profile, l['organizerUserId'])
+        for l in conf_lines if not l.get('_key')]))
+    conferences = []
+    for line in conf_lines:
+        if line.get('_key'):
+            key = ndb.Key(urlsafe=line['_key'])
+        else:
+            key = next(new_keys)
+        if line.get('_ref'):
+            refs[line['_ref']] = key.urlsafe()
+        conferences.append(_conferenceFromLine(line, key))
+    _putInBatches(conferences)
+    return conferences, skipped
+
+
+def _importSessions(lines, chunk, refs):
+    """Write a chunk's sessions; return (sessions, lines skipped)."""
+    sess_lines, parents, skipped = [], [], 0
+    for line in lines:
+        if line.get('_kind') != 'ConferenceSession':
+            continue
+        # parent is an imported conference ref or an existing key
+        parent = line.get('_conference')
+        if line.get('_key'):
+            sess_lines.append(line)
+        elif parent:
+            sess_lines.append(line)
+            parents.append(ndb.Key(urlsafe=refs.get(parent) or parent))
+        else:
+            skipped += 1
+
+    new_keys = iter(_chunkKeys(chunk, 'sessions', ConferenceSession,
+                               parents))
+    sessions = []
+    for line in sess_lines:
+        if line.get('_key'):
+            key = ndb.Key(urlsafe=line['_key'])
+        else:
+            key = next(new_keys)
+        sessions.append(_sessionFromLine(line, key))
+    _putInBatches(sessions)
+    return sessions, skipped
+
+
+def startImport(ndjson, notify=False):
+    """Store NDJSON in chunks and start importing them; return the status.
+
+    Raises ValueError, storing nothing, if a line is not JSON. Conferences are written before sessions so that session parents
+    exist. Side effects (featured speaker checks, the announcement and,
+    if notify is set, organizer emails) are queued as batched tasks
+    after each chunk's writes have completed.
+    """
+    status = ImportStatus(id=uuid.uuid4().hex, runId=int(time.time()),
+                          phase='conferences', notify=notify, refs={})
+    chunks, lines, size = [], [], 0
+    for raw in ndjson.splitlines():
+        if not raw.strip():
+            continue
+        if not isinstance(json.loads(raw), dict):
+            raise ValueError('not a JSON object: %r' % raw[:80])
+        if lines and size + len(raw) > IMPORT_CHUNK_BYTES:
+            chunks.append('\n'.join(lines))
+            lines, size = [], 0
+        lines.append(raw)
+        size += len(raw) + 1
+    if lines:
+        chunks.append('\n'.join(lines))
+
+    status.chunks = len(chunks)
+    status.done = not chunks
+    status.put()
+    entities = [ImportChunk(parent=status.key, id=i + 1, data=data)
+                for i, data in enumerate(chunks)]
+    for i in xrange(0, len(entities), IMPORT_CHUNK_PUT):
+        ndb.put_multi(entities[i:i + IMPORT_CHUNK_PUT], **BULK_PUT_OPTIONS)
+    if chunks:
+        chainBatch(status, IMPORT_URL, 'import-%s' % status.key.id(),
+                   {'id': status.key.id()})
+    return status
+
+
+def _saveRefs(refs):
+    """checkpoint() update keeping new refs and moving on to sessions."""
+    def update(status):
+        saved = dict(status.refs or {})
+        saved.update(refs)
+        status.refs = saved
+        if status.done and status.phase == 'conferences':
+            # cursor is None again: the session pass starts from chunk 1
+            status.phase = 'sessions'
+            status.done = False
+    return update
+
+
+def runImportBatch(import_id, run_id, batch):
+    """Import one chunk for the current phase and chain the next one."""
+    status = ImportStatus.get_by_id(import_id)
+    prefix = 'import-%s' % import_id
+    params = {'id': import_id}
+    if not runBatch(status, run_id, batch, IMPORT_URL, prefix, params):
+        return
+    chunks, cursor, more = ImportChunk.query(ancestor=status.key).fetch_page(
+        1, start_cursor=pageCursor(status), **BULK_PUT_OPTIONS)
+
+    refs, tasks, counters = {}, [], {}
+    for chunk in chunks:
+        lines = [json.loads(raw) for raw in chunk.data.splitlines()
+                 if raw.strip()]
+        name = '%s-%s-%d' % (prefix, status.phase, chunk.key.id())
+        if status.phase == 'conferences':
+            conferences, skipped = _importConferences(lines, chunk, refs)
+            if status.notify:
+                tasks = [taskqueue.Task(params={'email': c.organizerUserId,
+                                                'conferenceInfo': c.name},
+                                        url='/tasks/send_confirmation_email',
+                                        name=taskName('%s-%d' % (name, i)))
+                         for i, c in enumerate(conferences)]
+            counters = {'conferences': len(conferences), 'skipped': skipped}
+        else:
+            sessions, skipped = _importSessions(lines, chunk,
+                                                status.refs or {})
+            # one featured speaker check per (conf, speaker)
+            speaker_checks = sorted(set(
+                (s.key.parent().urlsafe(), speaker.name)
+                for s in sessions for speaker in s.speakers))
+            tasks = [taskqueue.Task(params={'conf_key': conf_key,
+                                            'speaker_name': speaker_name},
+                                    url='/tasks/set_featured_speaker',
+                                    name=taskName('%s-%d' % (name, i)))
+                     for i, (conf_key, speaker_name)
+                     in enumerate(speaker_checks)]
+            counters = {'sessions': len(sessions), 'skipped': skipped}
+    _addInBatches(tasks)
+
+    status = checkpoint(status, cursor, more, update=_saveRefs(refs),
+                        tasks=len(tasks), **counters)
+    if status is None:
+        return
+    if not status.done:
+        chainBatch(status, IMPORT_URL, prefix, params)
+        return
+    _addInBatches([taskqueue.Task(url='/crons/set_announcement',
+                                  method='GET',
+                                  name=taskName(prefix + '-announce'))])
+    ndb.delete_multi(ImportChunk.query(ancestor=status.key).fetch(
+        keys_only=True))
+
+
+def importReport(import_id):
+    """Return an import's progress as a dict, or None if there is none."""
+    status = ImportStatus.get_by_id(import_id) if import_id else None
+    if status is None:
+        return None
+    return {'importId': import_id,
+            'phase': status.phase,
+            'chunks': status.chunks,
+            'batches': status.batches,
+            'done': status.done,
+            'conferences': status.conferences,
+            'sessions': status.sessions,
+            'skipped': status.skipped,
+            'tasks': status.tasks}
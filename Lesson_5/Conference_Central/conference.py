@@ -13,16 +13,22 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import logging
+import time
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
+from protorpc import protojson
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 
@@ -43,8 +49,29 @@ from models import ConferenceSessionForms
 from models import Speaker
 from models import SessionWishlist
 from models import SessionWishlistForm
-
-from utils import getUserId
+from models import Attendee
+from models import AttendeeForm
+from models import AttendeeForms
+from models import Tombstone
+from models import ChangesForm
+from models import FacetForms
+
+from facets import enqueueDelta
+from facets import facetForms
+from facets import facetSnapshot
+from hotkeys import hotGet
+from hotkeys import invalidate
+from hotkeys import peek
+from listings import degradable
+from listings import listingFetch
+from listings import listingGet
+from metrics import instrumented
+from querylog import loggedFetch
+from querylog import loggedFetchPage
+from ratelimit import rateLimited
+from requestcontext import current
+from utils import getRelated
+from utils import getRelatedAsync
 
 from settings import WEB_CLIENT_ID
 
@@ -53,6 +80,14 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
 MEMCACHE_FEATURED_SESSIONS_KEY = "FEATURED_SESSIONS"
+SYNC_PAGE_SIZE = 200
+ATTENDEES_PAGE_SIZE = 100
+ATTENDEES_MAX_PAGE_SIZE = 500
+# updated-index queries are eventually consistent; never advance a sync
+# token into the last few seconds, so late-indexed writes are re-sent
+SYNC_SAFETY_WINDOW = timedelta(seconds=10)
+# most changes sharing one timestamp that a single call will send
+SYNC_MAX_TIES = 1000
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -95,30 +130,53 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 
 SPEAKER_SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeSpeaker=messages.StringField(1)
+    websafeSpeaker=messages.StringField(1),
+    includeDescription=messages.BooleanField(2)
 )
 
 CONF_SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeConferenceKey=messages.StringField(1)
+    websafeConferenceKey=messages.StringField(1),
+    includeDescription=messages.BooleanField(2)
 )
 
 TYPE_SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeType=messages.StringField(1),
-    websafeConferenceKey=messages.StringField(2)
+    websafeConferenceKey=messages.StringField(2),
+    includeDescription=messages.BooleanField(3)
 )
 
 HIGHLIGHT_SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeHighlight=messages.StringField(1)
+    websafeHighlight=messages.StringField(1),
+    includeDescription=messages.BooleanField(2)
 )
 
 TYPE_TIME_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeType=messages.StringField(1),
     websafeTime=messages.StringField(2),
-    websafeOperator=messages.StringField(3)
+    websafeOperator=messages.StringField(3),
+    includeDescription=messages.BooleanField(4)
+)
+
+# list endpoints leave (compressed) descriptions out unless asked
+LIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    includeDescription=messages.BooleanField(1)
+)
+
+ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    cursor=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32)
+)
+
+SYNC_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    syncToken=messages.StringField(1)
 )
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -131,10 +189,13 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, description=True):
         """Copy relevant fields from Conference to ConferenceForm."""
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if field.name == 'description' and not description:
+                # never touched, so never decompressed
+                continue
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -149,13 +210,13 @@ class ConferenceApi(remote.Service):
         return cf
 
 
-    def _createConferenceObject(self, request):
+    @ndb.tasklet
+    def _createConferenceObjectAsync(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        ctx = current()
+        user = ctx.requireUser()
+        user_id = ctx.userId
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -165,6 +226,7 @@ class ConferenceApi(remote.Service):
         del data['websafeKey']
         del data['organizerDisplayName']
         del data['month']
+        del data['version']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -185,35 +247,52 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        c_id = (yield Conference.allocate_ids_async(size=1, parent=p_key))[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
         # TODO 2
         # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        # creation of Conference & return (modified) ConferenceForm;
+        # the tasks describe a conference that exists, so they are only
+        # queued once the put has succeeded
+        conf = Conference(**data)
+        yield conf.put_async()
+        email = taskqueue.Queue().add_async(taskqueue.Task(
+            params={'email': user.email(),
+                    'conferenceInfo': repr(request)},
+            url='/tasks/send_confirmation_email'))
+        counted = enqueueDelta(conf, None, facetSnapshot(conf))
+        yield email
+        if counted:
+            yield counted
+
+        raise ndb.Return(request)
 
-        return request
 
-
-    @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        ctx = current()
+        ctx.requireUser()
+        user_id = ctx.userId
+
+        # the organizer's name is only needed for the response, so fetch
+        # it alongside (not inside) the transaction
+        prof_future = ctx.profileAsync()
+        try:
+            # no retries: a concurrent edit is reported, not replayed
+            conf = ndb.transaction(
+                lambda: self._applyConferenceUpdate(request, user_id),
+                retries=0)
+        except datastore_errors.TransactionFailedError:
+            raise ConflictException(
+                'The conference is being modified by someone else; '
+                'reload it and try again.')
+        prof = prof_future.get_result()
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
 
-        # update existing conference
+    def _applyConferenceUpdate(self, request, user_id):
+        """Compare-and-set update of a Conference; runs in a transaction."""
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
         if not conf:
@@ -225,9 +304,20 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # the client's copy must be the current one (if it sent a version);
+        # some conferences were stored with version None, which means 0
+        conf.version = conf.version or 0
+        if request.version is not None and request.version != conf.version:
+            raise ConflictException(
+                'The conference has been changed since version %d; reload '
+                'it and try again.' % request.version)
+
+        before = facetSnapshot(conf)
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name == 'version':
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -236,57 +326,86 @@ class ConferenceApi(remote.Service):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
                 # write to Conference object
                 setattr(conf, field.name, data)
+        conf.version += 1
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # queued only if the transaction commits
+        queued = enqueueDelta(conf, before, facetSnapshot(conf),
+                              transactional=True)
+        if queued:
+            queued.get_result()
+        return conf
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def createConference(self, request):
         """Create new conference."""
-        return self._createConferenceObject(request)
+        return self._createConferenceObjectAsync(request).get_result()
 
 
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
+    @rateLimited
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        form = self._updateConferenceObject(request)
+        invalidate(request.websafeConferenceKey)
+        return form
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
+    @rateLimited
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # popular conferences are served from replicated caches (hotkeys.py)
+        wsck = request.websafeConferenceKey
+        encoded = hotGet(wsck, lambda: protojson.encode_message(
+            self._loadConferenceForm(wsck)))
+        return protojson.decode_message(ConferenceForm, encoded)
+
+
+    def _loadConferenceForm(self, wsck):
+        """Return the ConferenceForm for a websafe conference key."""
+        # the organizer's Profile is the conference's parent, so both come
+        # back from one batch get; bail if the conference is not found
+        conf_key = ndb.Key(urlsafe=wsck)
+        found = getRelated(conf_key)
+        conf = found[conf_key]
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        prof = found[conf_key.parent()]
         # return ConferenceForm
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(LIST_GET_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
+    @rateLimited
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id =  getUserId(user)
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        ctx = current()
+        user_id = ctx.userId
+        # create ancestor query for all key matches for this user; the
+        # profile get runs alongside it
+        prof_future = ctx.profileAsync()
+        confs = Conference.query(ancestor=ndb.Key(Profile, user_id)).fetch()
+        prof = prof_future.get_result()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName'),
+                                              request.includeDescription)
+                   for conf in confs]
         )
 
 
@@ -342,25 +461,31 @@ class ConferenceApi(remote.Service):
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
+    @rateLimited
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        started = time.time()
+        conferences, complete = listingFetch(self._getQuery(request),
+                                             'queryConferences')
 
         # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
+        # get all keys in one batch, under the listing's deadline
         organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles, read = listingGet('queryConferences', started, *organisers)
 
         # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        for profile in profiles.itervalues():
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
-        )
+        return degradable('queryConferences', request, ConferenceForms(
+                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId),
+                                                  request.includeDescription)
+                       for conf in conferences]
+        ), complete and read)
 
 #-----------WISHLIST-----------------------------------------------
 
@@ -368,13 +493,14 @@ class ConferenceApi(remote.Service):
                       path='addSessionToWishlist',
                       http_method='POST',
                       name='addSessionToWishlist')
+    @instrumented
+    @rateLimited
     def addSessionToWishlist(self, request):
         """adds the session to the user's list of sessions they are interested in attending
 
         """
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        ctx = current()
+        ctx.requireUser()
 
         # retrieve the session
         sess = ndb.Key(urlsafe=request.session_key).get()
@@ -385,9 +511,9 @@ class ConferenceApi(remote.Service):
             )
 
         # retrieve the user's wishlist if one exists
-        wl = ndb.Key(SessionWishlist, getUserId(user)).get()
+        wl = ndb.Key(SessionWishlist, ctx.userId).get()
         if wl is None:
-            wl_key = ndb.Key(SessionWishlist, getUserId(user))
+            wl_key = ndb.Key(SessionWishlist, ctx.userId)
             wl = SessionWishlist(
                 key=wl_key,
                 session_keys=[request.session_key]
@@ -405,32 +531,36 @@ class ConferenceApi(remote.Service):
             session_key=request.session_key
         )
 
-    @endpoints.method(message_types.VoidMessage, ConferenceSessionForms,
+    @endpoints.method(LIST_GET_REQUEST, ConferenceSessionForms,
                       path='getSessionsInWishlist',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @instrumented
+    @rateLimited
     def getSessionsInWishlist(self, request):
         """query for all the sessions in a conference that the user is interested in"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        ctx = current()
+        ctx.requireUser()
 
-        wl = ndb.Key(SessionWishlist, getUserId(user)).get()
+        wl = ndb.Key(SessionWishlist, ctx.userId).get()
         if wl is not None:
             sess_keys = [ndb.Key(urlsafe=wl_sess_key) for wl_sess_key in wl.session_keys]
             q = ndb.get_multi(sess_keys)
             return ConferenceSessionForms(
-                items=[self._copySessionToForm(sess) for sess in q]
+                items=[self._copySessionToForm(sess, request.includeDescription)
+                       for sess in q]
             )
         return ConferenceSessionForms(
             items=[]
         )
 
 # - - - Session Stuff - - - - - - - - - - - - - - - - - - - -
-    def _copySessionToForm(self, sess):
+    def _copySessionToForm(self, sess, description=True):
         """Copy the session to the session form"""
         sf = ConferenceSessionForm()
         for field in sf.all_fields():
+            if field.name == 'description' and not description:
+                continue
             if hasattr(sess, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -451,22 +581,25 @@ class ConferenceApi(remote.Service):
                       path='getConferenceSessionsByHighlight/{websafeHighlight}',
                       http_method='GET',
                       name='getConferenceSessionsByHighlight')
+    @instrumented
+    @rateLimited
     def getConferenceSessionsByHighlight(self, request):
         """Query for sessions with the given highlight"""
         q = ConferenceSession.query(ConferenceSession.highlights.IN([request.websafeHighlight]))
-        if q is not None:
-            return ConferenceSessionForms(
-                items=[self._copySessionToForm(sess) for sess in q]
-            )
-        return ConferenceSessionForms(
-            items=[]
-        )
+        sessions, complete = listingFetch(q, 'getConferenceSessionsByHighlight')
+        return degradable('getConferenceSessionsByHighlight', request,
+                          ConferenceSessionForms(
+            items=[self._copySessionToForm(sess, request.includeDescription)
+                   for sess in sessions]
+        ), complete)
 
     #---------Task #3 filter query---------------------------------
     @endpoints.method(TYPE_TIME_GET_REQUEST, ConferenceSessionForms,
                       path='getConferenceSessionsByFilters',
                       http_method='GET',
                       name='getConferenceSessionsByFilters')
+    @instrumented
+    @rateLimited
     def getConferenceSessionsByFilters(self, request):
         """Query for the sessions that are not specified type
         and are not running after specified time
@@ -485,7 +618,8 @@ class ConferenceApi(remote.Service):
         q = ConferenceSession.query(ConferenceSession.type != type_f)
         print q
         sessions=[]
-        for sess in q:
+        candidates, complete = listingFetch(q, 'getConferenceSessionsByFilters')
+        for sess in candidates:
             if sess.start_time is not None:
                 if eq_f == '<':
                     if sess.start_time < datetime.strptime(time_f, '%H:%M').time():
@@ -499,62 +633,86 @@ class ConferenceApi(remote.Service):
                     if sess.start_time > datetime.strptime(time_f, '%H:%M').time():
                         # add the session to the sessions
                         sessions.append(sess)
-        return ConferenceSessionForms(
-            items=[self._copySessionToForm(s) for s in sessions]
-        )
+        return degradable('getConferenceSessionsByFilters', request,
+                          ConferenceSessionForms(
+            items=[self._copySessionToForm(s, request.includeDescription)
+                   for s in sessions]
+        ), complete)
 
     @endpoints.method(CONF_SESS_GET_REQUEST, ConferenceSessionForms,
                       path='getConferenceSessions/{websafeConferenceKey}',
                       http_method='GET',
                       name='getConferenceSessions')
+    @instrumented
+    @rateLimited
     def getConferenceSessions(self, request):
         """Query for sessions, given a conference"""
-        # query for the conference, and then query for the sessions by conference key
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        q = ConferenceSession.query(ancestor=conf.key)
+        # the query only needs the conference key, so the existence check
+        # runs alongside it rather than before it
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf_future = conf_key.get_async()
+        q = ConferenceSession.query(ancestor=conf_key)
         q.order(ConferenceSession.start_time)
+        sessions = loggedFetch(q, 'getConferenceSessions')
+        if not conf_future.get_result():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
         return ConferenceSessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess, request.includeDescription)
+                   for sess in sessions]
         )
 
     @endpoints.method(TYPE_SESS_GET_REQUEST, ConferenceSessionForms,
                       path='sessiontype/{websafeConferenceKey}/{websafeType}',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @instrumented
+    @rateLimited
     def getConferenceSessionsByType(self, request):
         """Query for sessions, given the type"""
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        q = ConferenceSession.query(ancestor=conf.key)
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf_future = conf_key.get_async()
+        q = ConferenceSession.query(ancestor=conf_key)
         q = q.filter(ConferenceSession.type == request.websafeType)
         q.order(ConferenceSession.start_time)
+        sessions = loggedFetch(q, 'getConferenceSessionsByType')
+        if not conf_future.get_result():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
         return ConferenceSessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess, request.includeDescription)
+                   for sess in sessions]
         )
 
     @endpoints.method(SPEAKER_SESS_GET_REQUEST, ConferenceSessionForms,
                       path='sessionspeaker/{websafeSpeaker}',
                       http_method='GET',
                       name='getSessionsBySpeaker')
+    @instrumented
+    @rateLimited
     def getSessionsBySpeaker(self, request):
         """Query for sessions with a given speaker"""
         q = ConferenceSession.query(ConferenceSession.speakers.name == request.websafeSpeaker)
         q.order(ConferenceSession.start_time)
-        return ConferenceSessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
-        )
-
-    def _createSessionObject(self, request):
+        sessions, complete = listingFetch(q, 'getSessionsBySpeaker')
+        return degradable('getSessionsBySpeaker', request, ConferenceSessionForms(
+            items=[self._copySessionToForm(sess, request.includeDescription)
+                   for sess in sessions]
+        ), complete)
+
+    @ndb.tasklet
+    def _createSessionObjectAsync(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        ctx = current()
+        ctx.requireUser()
 
         if not request.parent_key:
             raise endpoints.BadRequestException("Session 'parent_key' field required")
 
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['parent_key']
+        del data['websafeKey']
         if data['start_time']:
             # assumed that start time is given in 24 hour time :)
             t = datetime.strptime(data['start_time'], '%H:%M')
@@ -566,25 +724,121 @@ class ConferenceApi(remote.Service):
         for s in request.speakers:
             data['speakers'].append(Speaker(name=s))
 
-        conf = ndb.Key(urlsafe=request.parent_key).get()
-        sess = ConferenceSession(parent=conf.key, **data)
+        conf_key = ndb.Key(urlsafe=request.parent_key)
+        found = yield getRelatedAsync(conf_key)
+        if not found[conf_key]:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.parent_key)
+        sess = ConferenceSession(parent=conf_key, **data)
 
-        sess.put()
+        yield sess.put_async()
         # start the task to find a featured speaker
-        # if there are multiple speakers check each one
-        for speaker in data['speakers']:
-            taskqueue.add(params={'conf_key': request.parent_key,
-                                  'speaker_name': speaker.name},
-                          url='/tasks/set_featured_speaker'
-                          )
+        # if there are multiple speakers check each one (one batch add)
+        tasks = [taskqueue.Task(params={'conf_key': request.parent_key,
+                                        'speaker_name': speaker.name},
+                                url='/tasks/set_featured_speaker')
+                 for speaker in data['speakers']]
+        if tasks:
+            yield taskqueue.Queue().add_async(tasks)
 
-        return request
+        raise ndb.Return(request)
 
     @endpoints.method(ConferenceSessionForm, ConferenceSessionForm, path='createSession',
                       http_method='POST', name='createSession')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def createSession(self, request):
         """Create a Session. Requires the conference key passed in."""
-        return self._createSessionObject(request)
+        return self._createSessionObjectAsync(request).get_result()
+
+# - - - Delta sync - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _syncTokenToDatetime(token):
+        """Decode a sync token (microseconds since the epoch)."""
+        if not token:
+            return datetime.min
+        try:
+            return datetime.utcfromtimestamp(0) + timedelta(microseconds=int(token))
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid sync token.')
+
+    @staticmethod
+    def _datetimeToSyncToken(dt):
+        """Encode a datetime as a sync token."""
+        delta = dt - datetime.utcfromtimestamp(0)
+        return str((delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds)
+
+    @endpoints.method(SYNC_GET_REQUEST, ChangesForm,
+                      path='changes',
+                      http_method='GET',
+                      name='getChangesSince')
+    @instrumented
+    @rateLimited
+    def getChangesSince(self, request):
+        """Return conferences and sessions changed or deleted since syncToken.
+
+        Pass the returned syncToken on the next call; keep calling while
+        'more' is set. Entities may be returned more than once.
+        """
+        since = self._syncTokenToDatetime(request.syncToken)
+        # >= rather than >: changes sharing the timestamp a page stopped
+        # at are sent again instead of skipped
+        kinds = [(Conference, Conference.updated),
+                 (ConferenceSession, ConferenceSession.updated),
+                 (Tombstone, Tombstone.deleted)]
+        futures = [model.query(prop >= since).order(prop).fetch_async(
+                       SYNC_PAGE_SIZE) for model, prop in kinds]
+        pages = [f.get_result() for f in futures]
+        props = [prop for _, prop in kinds]
+        stamps = lambda ents, prop: [prop._get_value(e) for e in ents]
+
+        # resume from the earliest point a full page stopped at, so no
+        # kind skips anything; otherwise from the newest change seen
+        full = [stamps(ents, prop)[-1] for ents, prop in zip(pages, props)
+                if len(ents) == SYNC_PAGE_SIZE]
+        if full:
+            next_since = min(full)
+        else:
+            next_since = max([since] + [max(stamps(ents, prop))
+                                        for ents, prop in zip(pages, props)
+                                        if ents])
+        if full and next_since == since:
+            # a whole page shares one timestamp: send all of it and move
+            # past it, or the next call would return the same page
+            for page, (model, prop) in zip(pages, kinds):
+                if len(page) == SYNC_PAGE_SIZE and \
+                        stamps(page, prop)[-1] == since:
+                    seen = set(e.key for e in page)
+                    ties = model.query(prop == since).fetch(SYNC_MAX_TIES)
+                    if len(ties) == SYNC_MAX_TIES:
+                        logging.warning('getChangesSince: over %d %s '
+                                        'changes at %s; some are skipped',
+                                        SYNC_MAX_TIES, model._get_kind(),
+                                        since)
+                    page.extend(e for e in ties if e.key not in seen)
+            next_since = since + timedelta(microseconds=1)
+        more = bool(full)
+        # never advance into the safety window; a page stopped there is
+        # finished on a later call, not by calling again straight away
+        cap = datetime.utcnow() - SYNC_SAFETY_WINDOW
+        if next_since > cap:
+            next_since = max(since, cap)
+            more = False
+        confs, sessions, tombstones = pages
+
+        organisers = ndb.get_multi(list(set(
+            [ndb.Key(Profile, conf.organizerUserId) for conf in confs])))
+        names = dict((p.key.id(), p.displayName) for p in organisers if p)
+        return ChangesForm(
+            conferences=[self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId)) for conf in confs],
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            deletedKeys=[t.key.id() for t in tombstones],
+            syncToken=self._datetimeToSyncToken(next_since),
+            more=more
+        )
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
@@ -603,37 +857,48 @@ class ConferenceApi(remote.Service):
         return pf
 
 
-    def _getProfileFromUser(self):
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        ctx = current()
+        user = ctx.requireUser()
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        # get Profile from datastore (shared with the rest of the request)
+        profile = yield ctx.profileAsync()
         # create new Profile if not there
         if not profile:
-            profile = Profile(
-                key = p_key,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
+            profile = self._newProfile(user, ctx.profileKey)
+            yield profile.put_async()
+            ctx.remember(profile)
+
+        raise ndb.Return(profile)      # return Profile
 
-        return profile      # return Profile
+
+    def _getProfileFromUser(self):
+        """Blocking _getProfileFromUserAsync()."""
+        return self._getProfileFromUserAsync().get_result()
 
 
-    def _doProfile(self, save_request=None):
+    @staticmethod
+    def _newProfile(user, p_key):
+        """Return a default (unsaved) Profile for user."""
+        return Profile(
+            key = p_key,
+            displayName = user.nickname(),
+            mainEmail= user.email(),
+            teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
+        )
+
+
+    @ndb.tasklet
+    def _doProfileAsync(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
-        prof = self._getProfileFromUser()
+        prof = yield self._getProfileFromUserAsync()
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            old_name = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -643,41 +908,69 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-            prof.put()
+            # the rename doesn't depend on the put; wait for both so
+            # either failing fails the call
+            writes = [prof.put_async()]
+            if prof.displayName != old_name:
+                writes.append(self._renameAttendeesAsync(prof))
+            yield writes
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        raise ndb.Return(self._copyProfileToForm(prof))
+
+
+    @ndb.tasklet
+    def _renameAttendeesAsync(self, prof):
+        """Copy a changed displayName to the profile's Attendee entries."""
+        keys = [ndb.Key(Attendee, prof.key.id(), parent=ndb.Key(urlsafe=wsck))
+                for wsck in prof.conferenceKeysToAttend]
+        attendees = [a for a in (yield ndb.get_multi_async(keys)) if a]
+        for attendee in attendees:
+            attendee.displayName = prof.displayName
+        yield ndb.put_multi_async(attendees)
 
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def getProfile(self, request):
         """Return user profile."""
-        return self._doProfile()
+        return self._doProfileAsync().get_result()
 
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def saveProfile(self, request):
         """Update & return user profile."""
-        return self._doProfile(request)
+        return self._doProfileAsync(request).get_result()
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
-    def _conferenceRegistration(self, request, reg=True):
+    @ndb.transactional_tasklet(xg=True)
+    def _conferenceRegistrationAsync(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
+        ctx = current()
+        user = ctx.requireUser()
 
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get the user's Profile and the conference in one batch; create
+        # the Profile if not there, check that the conference exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        p_key = ndb.Key(Profile, ctx.userId)
+        conf_key = ndb.Key(urlsafe=wsck)
+        found = yield getRelatedAsync(p_key, conf_key)
+        prof = found[p_key] or self._newProfile(user, p_key)
+        conf = found[conf_key]
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        before = facetSnapshot(conf)
 
         # register
         if reg:
@@ -694,6 +987,8 @@ class ConferenceApi(remote.Service):
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            attendee = Attendee(parent=conf_key, id=ctx.userId,
+                                displayName=prof.displayName)
             retval = True
 
         # unregister
@@ -708,33 +1003,83 @@ class ConferenceApi(remote.Service):
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
-
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        # write things back to the datastore & return; the conference's
+        # Attendee children mirror the profiles' conferenceKeysToAttend
+        if reg:
+            writes = ndb.put_multi_async([prof, conf, attendee])
+        else:
+            writes = (ndb.put_multi_async([prof, conf]) +
+                      [ndb.Key(Attendee, ctx.userId, parent=conf_key).delete_async()])
+        # seats sold per facet, queued only if the transaction commits
+        queued = enqueueDelta(conf, before, facetSnapshot(conf),
+                              transactional=True)
+        yield writes
+        if queued:
+            yield queued
+        raise ndb.Return(BooleanMessage(data=retval))
+
+
+    @endpoints.method(LIST_GET_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
         conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # organizers are the conferences' parents: one batch for both
+        found = getRelated(*conf_keys)
+        conferences = [found[k] for k in conf_keys]
 
         # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        for conf in conferences:
+            names[conf.organizerUserId] = getattr(
+                found[conf.key.parent()], 'displayName', None)
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in conferences]
+            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId],
+                                              request.includeDescription)
+                   for conf in conferences]
+        )
+
+    @staticmethod
+    def attendeeQuery(conf_key):
+        """Projection query over a conference's Attendee reverse index."""
+        return Attendee.query(ancestor=conf_key).order(Attendee.displayName)
+
+
+    @endpoints.method(ATTENDEES_GET_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @instrumented
+    @rateLimited
+    def getConferenceAttendees(self, request):
+        """Return one page of a conference's attendees (organizer only)."""
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # the organizer's Profile is the conference's parent
+        if conf_key.parent().id() != current().userId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can list attendees.')
+        try:
+            cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+        except (datastore_errors.BadValueError, TypeError):
+            raise endpoints.BadRequestException('Invalid cursor.')
+        if request.pageSize is not None and request.pageSize < 1:
+            raise endpoints.BadRequestException('pageSize must be at least 1.')
+        page_size = min(request.pageSize or ATTENDEES_PAGE_SIZE,
+                        ATTENDEES_MAX_PAGE_SIZE)
+        attendees, next_cursor, more = loggedFetchPage(
+            self.attendeeQuery(conf_key), 'getConferenceAttendees',
+            page_size, start_cursor=cursor, projection=[Attendee.displayName])
+        return AttendeeForms(
+            items=[AttendeeForm(userId=a.key.id(), displayName=a.displayName)
+                   for a in attendees],
+            nextCursor=next_cursor.urlsafe() if (more and next_cursor) else None,
+            more=more
         )
 
     #---------Custom query #2--------------------------------------
@@ -742,44 +1087,72 @@ class ConferenceApi(remote.Service):
                       path='getConferencesWithSessionHighlights/{websafeHighlight}',
                       http_method='GET',
                       name='getConferencesWithSessionHighlights')
+    @instrumented
+    @rateLimited
     def getConferencesWithSessionHighlights(self, request):
         """Query for conferences that have a session with the given highlights"""
         q = ConferenceSession.query(ConferenceSession.highlights.IN([request.websafeHighlight]))
+        started = time.time()
+        sess_keys, complete = listingFetch(
+            q, 'getConferencesWithSessionHighlights', keys_only=True)
+
+        # grab the confs for the sessions, and their organizers (the
+        # confs' parents), in one batch
+        conf_keys = []
+        seen = set()
+        for sess_key in sess_keys:
+            if sess_key.parent() not in seen:
+                seen.add(sess_key.parent())
+                conf_keys.append(sess_key.parent())
+        found, read = listingGet('getConferencesWithSessionHighlights',
+                                 started, *conf_keys)
+        complete = complete and read
+        confs = [found[k] for k in conf_keys if found[k]]
+
+        # put display names in dict
+        names = {}
+        for conf in confs:
+            names[conf.organizerUserId] = getattr(
+                found[conf.key.parent()], 'displayName', None)
 
-        if q is not None:
-            # grab the confs for the sessions
-            confs = [sess.key.parent().get() for sess in q]
-
-            # grab organizers of each conference
-            organizers = [ndb.Key(Profile, conf.organizerUserId) for conf in confs]
-            profiles = ndb.get_multi(organizers)
-
-            # put display names in dict
-            names = {}
-            for profile in profiles:
-                names[profile.key.id()] = profile.displayName
-
-            return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in confs]
-            )
-        return ConferenceForms(
-            items=[]
-        )
+        return degradable('getConferencesWithSessionHighlights', request,
+                          ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId],
+                                              request.includeDescription)
+                   for conf in confs]
+        ), complete)
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        # in a flash crowd for a sold-out conference, turn requests away
+        # from the cached copy instead of queueing on its entity group
+        cached = peek(request.websafeConferenceKey)
+        if (cached is not None and protojson.decode_message(
+                ConferenceForm, cached).seatsAvailable <= 0):
+            raise ConflictException(
+                "There are no seats available.")
+        result = self._conferenceRegistrationAsync(request).get_result()
+        invalidate(request.websafeConferenceKey)
+        return result
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
+    @rateLimited
+    @ndb.toplevel
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        result = self._conferenceRegistrationAsync(request, reg=False).get_result()
+        invalidate(request.websafeConferenceKey)
+        return result
 
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
@@ -789,10 +1162,11 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
+        confs = loggedFetch(Conference.query(ndb.AND(
             Conference.seatsAvailable <= 5,
             Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.seatsAvailable, Conference.name])
+        ), '_cacheAnnouncement',
+            projection=[Conference.seatsAvailable, Conference.name])
 
         if confs:
             # If there are almost sold out conferences,
@@ -814,6 +1188,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @instrumented
+    @rateLimited
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         # TODO 1
@@ -823,6 +1199,16 @@ class ConferenceApi(remote.Service):
             announcement = ""
         return StringMessage(data=announcement)
 
+
+    @endpoints.method(message_types.VoidMessage, FacetForms,
+                      path='conferences/facets',
+                      http_method='GET', name='getConferenceFacets')
+    @instrumented
+    @rateLimited
+    def getConferenceFacets(self, request):
+        """Return conference and seats-sold counts per city, topic and month."""
+        return facetForms()
+
 #---------Task #4--------------------------------------------
 
     @staticmethod
@@ -837,7 +1223,7 @@ class ConferenceApi(remote.Service):
         q = ConferenceSession.query(ancestor=conf.key)
         q = q.filter(ConferenceSession.speakers.name.IN([speaker_name]))
         session_names=[sess.name for sess in q]
-        if q.count(limit=2) > 1:
+        if len(session_names) > 1:
             memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, speaker_name)
             memcache.set(MEMCACHE_FEATURED_SESSIONS_KEY, session_names)
 
@@ -845,6 +1231,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/featured_speaker/get',
                       http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
+    @rateLimited
     def getFeaturedSpeaker(self, request):
         """Returns the featured speaker for the conference and
         the names of the speaker's sessions as a string
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+export.py -- Udacity conference server-side Python App Engine
+    newline-delimited JSON (NDJSON) export of the datastore
+
+Kinds are walked one after another in cursor-driven fetch_page batches,
+so the walk itself only holds a single batch in memory. App Engine
+buffers whole responses, though, so a request handler caps what it
+writes with max_bytes. A resume token of the form
+'<kind index>:<urlsafe cursor>' lets a caller (or a chained task) pick up
+exactly where the previous request stopped.
+
+"""
+
+import json
+from datetime import date
+from datetime import datetime
+from datetime import time
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceSession
+from models import Profile
+from models import SessionWishlist
+
+EXPORT_KINDS = (Conference, ConferenceSession, Profile, SessionWishlist)
+EXPORT_BATCH_SIZE = 200
+
+# exported entities are only read once; keep them out of the in-context
+# cache and memcache so memory use stays flat over large exports
+EXPORT_QUERY_OPTIONS = {'use_cache': False, 'use_memcache': False}
+
+
+def _jsonValue(value):
+    """Convert datastore values into something json can serialize."""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, list):
+        return [_jsonValue(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _jsonValue(v)) for k, v in value.iteritems())
+    return value
+
+
+def entityToJson(entity):
+    """Serialize an entity as a single NDJSON line (without newline)."""
+    data = _jsonValue(entity.to_dict())
+    data['_kind'] = entity.key.kind()
+    data['_key'] = entity.key.urlsafe()
+    return json.dumps(data, sort_keys=True)
+
+
+def parseToken(token):
+    """Split a resume token into (kind index, Cursor)."""
+    if not token:
+        return 0, None
+    kind_index, _, cursor = token.partition(':')
+    return int(kind_index), (Cursor(urlsafe=cursor) if cursor else None)
+
+
+def makeToken(kind_index, cursor):
+    """Build a resume token; None once every kind has been exported."""
+    if kind_index >= len(EXPORT_KINDS):
+        return None
+    return '%d:%s' % (kind_index, cursor.urlsafe() if cursor else '')
+
+
+def exportBatches(token=None, max_batches=None, batch_size=EXPORT_BATCH_SIZE,
+                  max_bytes=None):
+    """Yield (ndjson chunk, resume token) per fetched batch.
+
+    The resume token yielded with a chunk points just past that chunk, so
+    a caller may stop after any chunk and resume later from its token.
+    Stops after max_batches chunks, or once the chunks so far add up to
+    max_bytes (so the last chunk may overshoot it).
+    """
+    kind_index, cursor = parseToken(token)
+    batches = written = 0
+    while kind_index < len(EXPORT_KINDS):
+        if max_batches is not None and batches >= max_batches:
+            return
+        if max_bytes is not None and written >= max_bytes:
+            return
+        model = EXPORT_KINDS[kind_index]
+        entities, cursor, more = model.query().fetch_page(
+            batch_size, start_cursor=cursor, **EXPORT_QUERY_OPTIONS)
+        if not more:
+            kind_index, cursor = kind_index + 1, None
+        batches += 1
+        chunk = ''.join(entityToJson(e) + '\n' for e in entities)
+        written += len(chunk)
+        yield chunk, makeToken(kind_index, cursor)
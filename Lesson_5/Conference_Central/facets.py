@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- Udacity conference server-side Python App Engine
+    precomputed conference counts per city, topic and month
+
+Each FacetCount entity holds, for one facet value ('city:London',
+'topic:Web', 'month:6'), the number of conferences and the seats sold in
+them (maxAttendees - seatsAvailable).
+
+Writers compare a conference's facetSnapshot() from before and after
+their change and queue the difference with enqueueDelta(), together with
+the conference's `updated` timestamp. Transactional writers queue it
+transactionally, so it is queued only if they commit. Deltas go to the
+facet-deltas pull queue, tagged with the tenant. Once a minute
+flushDeltas() leases them, sums them and applies the sums in a few
+cross-group transactions, then drops the cached counts once. Counts are
+therefore up to a minute behind, plus up to FACET_CACHE_TTL in
+facetForms().
+
+A flush that fails after applying its deltas applies them again, so the
+nightly rebuild (startRebuild) recounts every conference. It runs as a
+cursor-chained task chain (see taskchain.py), in key order, and records
+for each batch its last key and when it read its conferences. Flushes
+keep applying deltas to the live counts while it runs. A delta newer
+than the read of the batch that counted its conference is missing from
+the recount, so it is also journaled in the FacetRebuild entity. Deltas
+for conferences no batch has reached yet are held until one does. The
+journal is added to the recount before it replaces the live counts.
+Flushes wait while the recount is swapped in; after the swap they skip
+deltas the recount already covers.
+
+"""
+
+import collections
+import copy
+import json
+import time
+from datetime import datetime
+
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FacetCount
+from models import FacetForm
+from models import FacetForms
+from models import FacetRebuild
+from taskchain import chainBatch
+from taskchain import checkpoint
+from taskchain import pageCursor
+from taskchain import runBatch
+from tenants import currentTenant
+
+FACET_CACHE_KEY = 'FACETS'
+FACET_CACHE_TTL = 5 * 60
+FACET_DELTA_QUEUE = 'facet-deltas'
+FACET_FLUSH_BATCH = 500
+# leases per flush; later deltas wait for the next one
+FACET_FLUSH_MAX_LEASES = 20
+FACET_LEASE_SECONDS = 5 * 60
+FACET_REBUILD_URL = '/tasks/rebuild_facets'
+FACET_REBUILD_BATCH_SIZE = 500
+FACET_REBUILD_ID = 'facets'
+# cross-group transactions span at most 25 entity groups
+FACET_XG_CHUNK = 20
+# fixed width, so stamps compare as strings
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def facetSnapshot(conf):
+    """Return (facet keys, seats sold) for a conference, or None."""
+    if conf is None:
+        return None
+    keys = ['topic:%s' % t for t in conf.topics or []]
+    if conf.city:
+        keys.append('city:%s' % conf.city)
+    if conf.startDate:
+        keys.append('month:%d' % conf.startDate.month)
+    sold = max(0, (conf.maxAttendees or 0) - (conf.seatsAvailable or 0))
+    return keys, sold
+
+
+def facetDelta(before, after):
+    """{facet key: [conferences delta, seats sold delta]} between snapshots."""
+    delta = collections.defaultdict(lambda: [0, 0])
+    for snapshot, sign in ((before, -1), (after, 1)):
+        if snapshot:
+            keys, sold = snapshot
+            for key in keys:
+                delta[key][0] += sign
+                delta[key][1] += sign * sold
+    return dict((k, v) for k, v in delta.iteritems() if v != [0, 0])
+
+
+def _addCounts(totals, delta):
+    """Add a delta into a {facet key: [conferences, seats sold]} dict."""
+    for key, (conferences, sold) in delta.iteritems():
+        counts = totals.setdefault(key, [0, 0])
+        counts[0] += conferences
+        counts[1] += sold
+    return totals
+
+
+def _tag():
+    # pull queues are not namespaced; tasks carry their tenant as a tag
+    return 'ns:' + currentTenant()
+
+
+def enqueueDelta(conf, before, after, transactional=False):
+    """Queue the facet change between two snapshots; returns an RPC.
+
+    conf must have been put (or its put started), so `updated` is set.
+    """
+    delta = facetDelta(before, after)
+    if not delta:
+        return None
+    task = taskqueue.Task(method='PULL', tag=_tag(), payload=json.dumps({
+        'conference': conf.key.urlsafe(),
+        'updated': conf.updated.strftime(STAMP_FORMAT),
+        'delta': delta}))
+    return taskqueue.Queue(FACET_DELTA_QUEUE).add_async(
+        task, transactional=transactional)
+
+
+def _applyChunk(items):
+    keys = [ndb.Key(FacetCount, k) for k, _ in items]
+    counts = ndb.get_multi(keys)
+    for i, (key, (conferences, sold)) in enumerate(items):
+        if counts[i] is None:
+            facet, value = key.split(':', 1)
+            counts[i] = FacetCount(id=key, facet=facet, value=value)
+        counts[i].conferences += conferences
+        counts[i].seatsSold += sold
+    ndb.put_multi(counts)
+
+
+def _readBy(reads, conference):
+    """When the batch counting a conference read it; None if none has."""
+    pairs = ndb.Key(urlsafe=conference).pairs()
+    for last_key, read in reads or []:
+        if pairs <= ndb.Key(urlsafe=last_key).pairs():
+            return read
+    return None
+
+
+def _missed(delta, read):
+    """True if a delta is newer than the recount's read of its conference."""
+    return read is None or delta['updated'] > read
+
+
+def _journal(deltas):
+    """Check deltas against the rebuild; in a transaction.
+
+    Returns the deltas to apply to the live counts, or None while the
+    recount is being swapped in.
+    """
+    status = FacetRebuild.get_by_id(FACET_REBUILD_ID)
+    if status is None:
+        return deltas
+    if status.swapping:
+        return None
+    if status.done:
+        # the recount replaced the live counts; skip what it covered
+        return [d for d in deltas
+                if _missed(d, _readBy(status.reads, d['conference']))]
+    pending = status.pending or {}
+    held = status.held or []
+    for d in deltas:
+        read = _readBy(status.reads, d['conference'])
+        if read is None:
+            held.append(d)
+        elif _missed(d, read):
+            _addCounts(pending, d['delta'])
+    status.pending = pending
+    status.held = held
+    status.put()
+    return deltas
+
+
+def _applyDeltas(deltas):
+    """Apply leased deltas; False, applying nothing, during a swap."""
+    deltas = ndb.transaction(lambda: _journal(deltas))
+    if deltas is None:
+        return False
+    totals = {}
+    for d in deltas:
+        _addCounts(totals, d['delta'])
+    items = sorted((k, v) for k, v in totals.iteritems() if v != [0, 0])
+    for i in range(0, len(items), FACET_XG_CHUNK):
+        chunk = items[i:i + FACET_XG_CHUNK]
+        ndb.transaction(lambda: _applyChunk(chunk), xg=True)
+    return True
+
+
+def flushDeltas():
+    """Apply the current tenant's queued deltas; return how many."""
+    queue = taskqueue.Queue(FACET_DELTA_QUEUE)
+    flushed = 0
+    for _ in range(FACET_FLUSH_MAX_LEASES):
+        tasks = queue.lease_tasks_by_tag(FACET_LEASE_SECONDS,
+                                         FACET_FLUSH_BATCH, tag=_tag())
+        if not tasks:
+            break
+        # during a swap the leases run out and a later flush retries
+        if not _applyDeltas([json.loads(t.payload) for t in tasks]):
+            break
+        queue.delete_tasks(tasks)
+        flushed += len(tasks)
+        if len(tasks) < FACET_FLUSH_BATCH:
+            break
+    if flushed:
+        memcache.delete(FACET_CACHE_KEY)
+    return flushed
+
+
+def facetForms():
+    """Return every facet count, from memcache when possible."""
+    cached = memcache.get(FACET_CACHE_KEY)
+    if cached is not None:
+        return protojson.decode_message(FacetForms, cached)
+    forms = FacetForms(items=[
+        FacetForm(facet=c.facet, value=c.value, conferences=c.conferences,
+                  seatsSold=c.seatsSold)
+        for c in FacetCount.query().fetch(batch_size=1000)
+        if c.conferences > 0])
+    forms.items.sort(key=lambda f: (f.facet, f.value))
+    memcache.set(FACET_CACHE_KEY, protojson.encode_message(forms),
+                 time=FACET_CACHE_TTL)
+    return forms
+
+# - - - Nightly rebuild - - - - - - - - - - - - - - - - - - -
+
+
+def startRebuild():
+    """Recount every conference from scratch."""
+    status = FacetRebuild(id=FACET_REBUILD_ID, runId=int(time.time()),
+                          counts={}, pending={}, held=[], reads=[])
+    status.put()
+    chainBatch(status, FACET_REBUILD_URL, 'facets')
+
+
+def _saveCounts(counts, last_key, read):
+    """checkpoint() update storing a counted batch, keeping the journal.
+
+    Held deltas the batch has reached are journaled if they are newer
+    than its read. After the last batch, deltas still held are for
+    conferences created after the last read, so they are journaled too.
+    The journal is then folded into the counts and the swap starts,
+    which holds flushes until it is done.
+    """
+    def update(status):
+        status.counts = counts
+        if last_key:
+            status.reads = (status.reads or []) + [[last_key, read]]
+        pending = status.pending or {}
+        held = []
+        for d in status.held or []:
+            seen = _readBy(status.reads, d['conference'])
+            if seen is None and not status.done:
+                held.append(d)
+            elif _missed(d, seen):
+                _addCounts(pending, d['delta'])
+        status.held = held
+        status.pending = pending
+        if status.done:
+            # a copy: the transaction may run this more than once
+            status.counts = _addCounts(copy.deepcopy(counts), pending)
+            status.pending = {}
+            status.swapping = True
+            status.done = False     # done once swapped in
+    return update
+
+
+def _finishSwap(run_id):
+    status = FacetRebuild.get_by_id(FACET_REBUILD_ID)
+    if status and status.runId == run_id:
+        status.swapping = False
+        status.done = True
+        status.put()
+
+
+def runRebuildBatch(run_id, batch):
+    """Count one batch of conferences; swap in the totals after the last."""
+    status = FacetRebuild.get_by_id(FACET_REBUILD_ID)
+    if status is None or status.runId != run_id:
+        return
+    if not status.swapping:
+        if not runBatch(status, run_id, batch, FACET_REBUILD_URL, 'facets'):
+            return
+        keys, cursor, more = Conference.query().fetch_page(
+            FACET_REBUILD_BATCH_SIZE, start_cursor=pageCursor(status),
+            keys_only=True)
+        # read by key (strongly consistent); deltas stamped after this
+        # read are journaled
+        read = datetime.utcnow().strftime(STAMP_FORMAT)
+        conferences = ndb.get_multi(keys, use_cache=False,
+                                    use_memcache=False)
+        counts = status.counts
+        for conf in conferences:
+            _addCounts(counts, facetDelta(None, facetSnapshot(conf)))
+        last_key = keys[-1].urlsafe() if keys else None
+        status = checkpoint(status, cursor, more,
+                            update=_saveCounts(counts, last_key, read))
+        if status is None:
+            return
+        if not status.swapping:
+            chainBatch(status, FACET_REBUILD_URL, 'facets')
+            return
+    # safe to repeat if this task is retried part way
+    _replaceCounts(status.counts)
+    ndb.transaction(lambda: _finishSwap(status.runId))
+
+
+def _replaceCounts(counts):
+    """Overwrite the stored counts with a full recount."""
+    stale = [k for k in FacetCount.query().iter(keys_only=True)
+             if k.id() not in counts]
+    entities = []
+    for key, (conferences, sold) in counts.iteritems():
+        facet, value = key.split(':', 1)
+        entities.append(FacetCount(id=key, facet=facet, value=value,
+                                   conferences=conferences, seatsSold=sold))
+    for i in range(0, len(entities), 500):
+        ndb.put_multi(entities[i:i + 500])
+    for i in range(0, len(stale), 500):
+        ndb.delete_multi(stale[i:i + 500])
+    memcache.delete(FACET_CACHE_KEY)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+hotkeys.py -- Udacity conference server-side Python App Engine
+    hot-key read replication for flash-crowd reads
+
+Every instance counts reads per key over HOT_KEY_WINDOW_SECONDS. Reads of
+a key read at least HOT_KEY_THRESHOLD times in the current or previous
+window are served from
+
+  1. an instance-local micro-cache holding values for HOT_KEY_LOCAL_TTL
+     seconds, then
+  2. one of HOT_KEY_REPLICAS memcache copies picked at random, so the
+     load spreads over several memcache shards instead of one,
+
+and only then from the loader. Cold keys always go to the loader (which
+may still hit ndb's own cache).
+
+Replica keys carry the key's generation, a memcache counter that
+invalidate() bumps after a write. A fill that read the old value before
+the bump writes replicas of the old generation, which nobody reads. The
+same applies to this instance's micro-cache. Other instances may serve
+the old value for up to HOT_KEY_LOCAL_TTL.
+
+"""
+
+import collections
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+
+from metrics import METRIC_TYPES
+from metrics import increment
+
+HOT_KEY_WINDOW_SECONDS = 10
+HOT_KEY_THRESHOLD = 50
+HOT_KEY_REPLICAS = 8
+HOT_KEY_REPLICA_TTL = 60
+HOT_KEY_LOCAL_TTL = 0.5
+HOT_KEY_LOCAL_MAX = 1000
+
+METRIC_TYPES['conference_hot_key_reads_total'] = (
+    'counter', 'Reads of hot keys, per source (local/replica/loader).')
+
+_lock = threading.Lock()
+_window = {'start': time.time(), 'counts': collections.Counter(),
+           'previous': collections.Counter()}
+_local = {}
+# qualified key -> time of this instance's last invalidate()
+_invalidated = {}
+
+
+def _qualified(key):
+    """Instance-local state is shared by all tenants; memcache is not."""
+    return (namespace_manager.get_namespace(), key)
+
+
+def _countRead(qkey, now):
+    """Count one read; return True if the key is hot."""
+    with _lock:
+        if now - _window['start'] >= HOT_KEY_WINDOW_SECONDS:
+            _window['previous'] = _window['counts']
+            _window['counts'] = collections.Counter()
+            _window['start'] = now
+        _window['counts'][qkey] += 1
+        return max(_window['counts'][qkey],
+                   _window['previous'][qkey]) >= HOT_KEY_THRESHOLD
+
+
+def _generationKey(key):
+    return 'HOTGEN:%s' % key
+
+
+def _generation(key):
+    """Return key's current generation, starting one if there is none."""
+    gen_key = _generationKey(key)
+    gen = memcache.get(gen_key)
+    if gen is None:
+        # an evicted counter must not restart at a value used before
+        memcache.add(gen_key, int(time.time() * 1000))
+        gen = memcache.get(gen_key)
+    return gen
+
+
+def _replicaKeys(key, gen):
+    return ['HOT:%s:%s:%d' % (key, gen, i) for i in range(HOT_KEY_REPLICAS)]
+
+
+def _remember(qkey, value, now):
+    with _lock:
+        if _invalidated.get(qkey, 0) >= now:
+            return          # invalidated while this value was loading
+        if len(_local) >= HOT_KEY_LOCAL_MAX:
+            for k in [k for k, (expires, _) in _local.items()
+                      if expires <= now]:
+                del _local[k]
+        if len(_local) < HOT_KEY_LOCAL_MAX:
+            _local[qkey] = (now + HOT_KEY_LOCAL_TTL, value)
+
+
+def hotGet(key, loader):
+    """Return the value for a string key, loader() computing it.
+
+    loader() results of None are never cached.
+    """
+    now = time.time()
+    qkey = _qualified(key)
+    if not _countRead(qkey, now):
+        return loader()
+
+    cached = _local.get(qkey)
+    if cached and cached[0] > now:
+        increment('conference_hot_key_reads_total', source='local')
+        return cached[1]
+
+    # the generation is read before loading, so a fill racing with
+    # invalidate() lands on replicas of the superseded generation
+    gen = _generation(key)
+    if gen is None:
+        return loader()     # memcache unavailable
+    replicas = _replicaKeys(key, gen)
+    value = memcache.get(random.choice(replicas))
+    if value is not None:
+        increment('conference_hot_key_reads_total', source='replica')
+    else:
+        increment('conference_hot_key_reads_total', source='loader')
+        value = loader()
+        if value is not None:
+            memcache.set_multi(dict((r, value) for r in replicas),
+                               time=HOT_KEY_REPLICA_TTL)
+    if value is not None:
+        _remember(qkey, value, now)
+    return value
+
+
+def peek(key):
+    """Return a hot key's cached value without loading it, or None."""
+    qkey = _qualified(key)
+    cached = _local.get(qkey)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    with _lock:
+        hot = max(_window['counts'][qkey],
+                  _window['previous'][qkey]) >= HOT_KEY_THRESHOLD
+    if not hot:
+        return None
+    gen = memcache.get(_generationKey(key))
+    if gen is None:
+        return None
+    return memcache.get(random.choice(_replicaKeys(key, gen)))
+
+
+def invalidate(key):
+    """Retire every cached copy of key after it has been written."""
+    qkey, now = _qualified(key), time.time()
+    with _lock:
+        _local.pop(qkey, None)
+        if len(_invalidated) >= HOT_KEY_LOCAL_MAX:
+            # only fills started before an invalidate() need its time
+            for k in [k for k, t in _invalidated.items()
+                      if t < now - HOT_KEY_REPLICA_TTL]:
+                del _invalidated[k]
+        _invalidated[qkey] = now
+    memcache.incr(_generationKey(key), initial_value=int(now * 1000))
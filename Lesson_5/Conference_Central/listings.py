@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+listings.py -- Udacity conference server-side Python App Engine
+    read policy, deadlines and degraded responses for listing endpoints
+
+listingFetch() runs a listing's query within its LISTING_DEADLINES entry.
+Global (non-ancestor) listings read with eventual consistency, which is
+faster and cannot stall on unapplied writes. Ancestor queries keep the
+default strong reads.
+
+listingGet() reads the entities a listing needs besides its query (e.g.
+organizer profiles) within what is left of the same deadline. Entities
+it could not read in time come back as None and make the listing
+incomplete.
+
+degradable() decides what a listing returns. A complete response is saved
+as the last good answer for that request, at most once per
+LAST_GOOD_REFRESH seconds per instance. Answers over LAST_GOOD_MAX_BYTES
+(memcache values are limited to 1 MB) are saved cut down to their first
+items and marked partial. When the deadline cut a response short, the
+last good answer is served instead, marked stale. If there is none, the
+partial answer is served, marked partial.
+
+"""
+
+import hashlib
+import threading
+import time
+
+from protorpc import protojson
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+from metrics import METRIC_TYPES
+from metrics import increment
+from querylog import boundedFetch
+from utils import getRelated
+
+# seconds a listing may spend in datastore before it degrades
+LISTING_DEADLINES = {
+    'queryConferences':                    2.0,
+    'getConferenceSessionsByHighlight':    2.0,
+    'getSessionsBySpeaker':                2.0,
+    'getConferenceSessionsByFilters':      3.0,
+    'getConferencesWithSessionHighlights': 2.0,
+}
+LAST_GOOD_TTL = 15 * 60
+LAST_GOOD_REFRESH = 60
+LAST_GOOD_MAX_BYTES = 900 * 1024
+# least time a listing's lookups get, even when its query used it all
+LISTING_MIN_LOOKUP_SECONDS = 0.1
+
+METRIC_TYPES['conference_degraded_responses_total'] = (
+    'counter', 'Listings cut short by their deadline, per endpoint/mode.')
+
+
+def listingFetch(query, name, **options):
+    """boundedFetch() with name's deadline and read policy."""
+    if query.ancestor is None:
+        options.setdefault('read_policy', ndb.EVENTUAL_CONSISTENCY)
+    return boundedFetch(query, name, LISTING_DEADLINES[name], **options)
+
+
+def listingGet(name, started, *keys):
+    """getRelated() within what is left of name's deadline.
+
+    started is when the listing began. Returns ({key: entity or None},
+    complete).
+    """
+    remaining = LISTING_DEADLINES[name] - (time.time() - started)
+    try:
+        return getRelated(*keys, deadline=max(LISTING_MIN_LOOKUP_SECONDS,
+                                              remaining)), True
+    except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError):
+        return dict((k, None) for k in keys), False
+
+
+_saved = {}
+_savedLock = threading.Lock()
+
+
+def _due(key):
+    """True at most once per LAST_GOOD_REFRESH seconds per key."""
+    now = time.time()
+    with _savedLock:
+        if now - _saved.get(key, 0) < LAST_GOOD_REFRESH:
+            return False
+        if len(_saved) > 10000:
+            _saved.clear()
+        _saved[key] = now
+        return True
+
+
+def _encodeCapped(form):
+    """Encode form, cutting its items down to fit LAST_GOOD_MAX_BYTES."""
+    encoded = protojson.encode_message(form)
+    if len(encoded) <= LAST_GOOD_MAX_BYTES:
+        return encoded
+    capped = protojson.decode_message(type(form), encoded)
+    capped.partial = True
+    while len(encoded) > LAST_GOOD_MAX_BYTES and capped.items:
+        keep = int(len(capped.items) * LAST_GOOD_MAX_BYTES * 0.9 /
+                   len(encoded))
+        capped.items = capped.items[:min(keep, len(capped.items) - 1)]
+        encoded = protojson.encode_message(capped)
+    return encoded
+
+
+def _lastGoodKey(name, request):
+    digest = hashlib.md5(protojson.encode_message(request)).hexdigest()
+    return 'LAST_GOOD:%s:%s' % (name, digest)
+
+
+def degradable(name, request, form, complete):
+    """Return form, or the last good one if form is incomplete."""
+    key = _lastGoodKey(name, request)
+    if complete:
+        if _due(key):
+            memcache.set(key, _encodeCapped(form), time=LAST_GOOD_TTL)
+        return form
+    last_good = memcache.get(key)
+    if last_good is not None:
+        form = protojson.decode_message(type(form), last_good)
+        form.stale = True
+    else:
+        form.partial = True
+    increment('conference_degraded_responses_total', endpoint=name,
+              mode='stale' if form.stale else 'partial')
+    return form
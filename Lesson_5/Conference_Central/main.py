@@ -12,18 +12,58 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import csv
+import json
+import uuid
+import zlib
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import users
+from google.appengine.ext import ndb
+from bulkload import importReport
+from bulkload import runImportBatch
+from bulkload import startImport
 from conference import ConferenceApi
+from export import exportBatches
+from facets import flushDeltas
+from facets import runRebuildBatch
+from facets import startRebuild
+from metrics import exposition
+from metrics import instrumented
+from migrations import migrationReport
+from migrations import runMigrationBatch
+from migrations import startMigration
+from models import ExportShard
+from profiler import getProfile
+from profiler import recentProfiles
+from querylog import slowQueries
+from seats import runReconcileBatch
+from seats import startReconcile
+from taskchain import addNamedTask
+from taskchain import batchParams
+from tenants import forEachTenant
+from utils import getUserId
+
+# bytes per export response (App Engine allows 32 MB) / batches per
+# stored shard (see export.py)
+EXPORT_MAX_BYTES = 8 * 1024 * 1024
+EXPORT_SHARD_BATCHES = 10
+ATTENDEES_CSV_BATCH_SIZE = 500
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @instrumented
     def get(self):
         """Set Announcement in Memcache."""
         # TODO 1
         ConferenceApi._cacheAnnouncement()
+        # cron runs in the default namespace; repeat for every tenant
+        if self.request.headers.get('X-AppEngine-Cron'):
+            forEachTenant(self.request.path)
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -37,6 +77,7 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Set the featured speaker in the memcache"""
         conf_key = self.request.get('conf_key')
@@ -46,8 +87,241 @@ class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
             speaker_name=speaker_name
         )
 
+class ExportHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Return one part of an NDJSON export, or start/read a sharded one.
+
+        App Engine buffers the whole response before sending it, so each
+        part stops after about EXPORT_MAX_BYTES; the X-Export-Cursor
+        header says where the next part starts.
+        """
+        export_id = self.request.get('exportId')
+        if export_id:
+            self._getShard(export_id, self.request.get('shard'))
+            return
+
+        token = self.request.get('cursor') or None
+        if self.request.get('sharded'):
+            # hand the export over to a chain of tasks writing ExportShards
+            export_id = uuid.uuid4().hex
+            _enqueueExportShard(export_id, 0, token)
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({'exportId': export_id}))
+            return
+
+        # write chunks; if we stopped early, tell the caller how to resume
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        next_token = None
+        for chunk, next_token in exportBatches(token,
+                                               max_bytes=EXPORT_MAX_BYTES):
+            self.response.out.write(chunk)
+        if next_token:
+            self.response.headers['X-Export-Cursor'] = next_token
+
+    def _getShard(self, export_id, sequence):
+        """Return one stored shard, or the list of shards so far."""
+        if not sequence:
+            shards = ExportShard.query(ExportShard.exportId == export_id)
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(sorted(
+                k.id() for k in shards.fetch(keys_only=True))))
+            return
+        shard = ExportShard.get_by_id('%s-%05d' % (export_id, int(sequence)))
+        if not shard:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        self.response.write(shard.data)
+
+
+def _enqueueExportShard(export_id, sequence, token):
+    """Chain the next shard task; named so retries don't fork the chain."""
+    addNamedTask('/tasks/export_shard',
+                 'export-%s-%d' % (export_id, sequence),
+                 {'exportId': export_id, 'sequence': sequence,
+                  'cursor': token or ''})
+
+class ExportShardHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Write one ExportShard and chain the task for the next one."""
+        export_id = self.request.get('exportId')
+        sequence = int(self.request.get('sequence'))
+        token = self.request.get('cursor') or None
+        chunks = []
+        next_token = None
+        for chunk, next_token in exportBatches(token, EXPORT_SHARD_BATCHES):
+            chunks.append(chunk)
+        ExportShard(id='%s-%05d' % (export_id, sequence),
+                    exportId=export_id,
+                    sequence=sequence,
+                    data=''.join(chunks)).put()
+        if next_token:
+            _enqueueExportShard(export_id, sequence + 1, next_token)
+
+class BulkImportHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Report progress of the import given by 'importId'."""
+        report = importReport(self.request.get('importId'))
+        if report is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report))
+
+    @instrumented
+    def post(self):
+        """Store NDJSON conferences/sessions and import them in tasks."""
+        try:
+            status = startImport(self.request.body,
+                                 notify=bool(self.request.get('notify')))
+        except ValueError:
+            self.abort(400, 'Every line must be a JSON object.')
+        self.response.set_status(202)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'importId': status.key.id(),
+                                        'chunks': status.chunks}))
+
+class RunImportHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Import one chunk of a bulk import."""
+        runImportBatch(self.request.get('id'), *batchParams(self.request))
+
+class MigrationHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Report progress of all registered migrations."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(migrationReport()))
+
+    @instrumented
+    def post(self):
+        """Start the migration given by 'name'."""
+        try:
+            startMigration(self.request.get('name'))
+        except KeyError:
+            self.abort(404)
+        self.redirect('/admin/migrations')
+
+class RunMigrationHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Run one batch of a migration."""
+        runMigrationBatch(self.request.get('name'),
+                          *batchParams(self.request))
+
+class FlushFacetsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Apply the queued conference changes to the facet counts."""
+        flushDeltas()
+        # cron runs in the default namespace; repeat for every tenant
+        if self.request.headers.get('X-AppEngine-Cron'):
+            forEachTenant(self.request.path)
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start the nightly recount of the facet counts."""
+        startRebuild()
+        # cron runs in the default namespace; repeat for every tenant
+        if self.request.headers.get('X-AppEngine-Cron'):
+            forEachTenant(self.request.path)
+
+class RunFacetRebuildHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Count one batch of conferences for the facet recount."""
+        runRebuildBatch(*batchParams(self.request))
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start recomputing seatsAvailable from registrations."""
+        startReconcile()
+        # cron runs in the default namespace; repeat for every tenant
+        if self.request.headers.get('X-AppEngine-Cron'):
+            forEachTenant(self.request.path)
+
+class RunSeatReconcileHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Reconcile one batch of conferences' seat counts."""
+        if runReconcileBatch(*batchParams(self.request)):
+            # seat counts may have moved; sold-out list follows them
+            ConferenceApi._cacheAnnouncement()
+
+class AttendeesCsvHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Stream a conference's attendees as CSV (organizer only)."""
+        conf_key = ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))
+        user = users.get_current_user()
+        # the organizer's Profile is the conference's parent
+        if not user or getUserId(user) != conf_key.parent().id():
+            self.abort(403)
+        self.response.headers['Content-Type'] = 'text/csv'
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename=attendees.csv')
+        writer = csv.writer(self.response.out)
+        writer.writerow(['userId', 'displayName'])
+        for attendee in ConferenceApi.attendeeQuery(conf_key).iter(
+                batch_size=ATTENDEES_CSV_BATCH_SIZE,
+                projection=['displayName']):
+            writer.writerow([attendee.key.id().encode('utf-8'),
+                             (attendee.displayName or '').encode('utf-8')])
+
+class MetricsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Expose endpoint metrics in Prometheus text format."""
+        self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        self.response.write(exposition())
+
+class ProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """List captured cProfile runs, or return one by 'id'."""
+        profile_id = self.request.get('id')
+        if not profile_id:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(recentProfiles()))
+            return
+        profile = getProfile(profile_id)
+        if not profile:
+            self.abort(404)
+        if self.request.get('format') == 'pstats':
+            # marshalled stats, loadable with pstats.Stats(filename)
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = (
+                'attachment; filename=%s.pstats' % str(profile_id))
+            self.response.write(zlib.decompress(profile['pstats']))
+            return
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(profile['report'])
+
+class SlowQueriesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the worst logged queries, slowest first."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(slowQueries(), indent=2))
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/admin/export', ExportHandler),
+    ('/tasks/export_shard', ExportShardHandler),
+    ('/admin/import', BulkImportHandler),
+    ('/tasks/bulk_import', RunImportHandler),
+    ('/admin/migrations', MigrationHandler),
+    ('/tasks/run_migration', RunMigrationHandler),
+    ('/crons/flush_facets', FlushFacetsHandler),
+    ('/crons/rebuild_facets', RebuildFacetsHandler),
+    ('/tasks/rebuild_facets', RunFacetRebuildHandler),
+    ('/crons/reconcile_seats', ReconcileSeatsHandler),
+    ('/tasks/reconcile_seats', RunSeatReconcileHandler),
+    ('/conference/attendees.csv', AttendeesCsvHandler),
+    ('/admin/metrics', MetricsHandler),
+    ('/admin/profiles', ProfilesHandler),
+    ('/admin/slow_queries', SlowQueriesHandler),
 ], debug=True)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+metrics.py -- Udacity conference server-side Python App Engine
+    per-endpoint latency histograms, RPC/payload/error counters
+
+@instrumented wraps ConferenceApi methods (below @endpoints.method) and
+webapp2 handler methods. Samples are aggregated in-instance as counter
+deltas keyed by Prometheus series, e.g.
+
+    conference_requests_total{endpoint="getConference"}
+
+and every FLUSH_INTERVAL_SECONDS added to memcache counters with one
+offset_multi call. exposition() renders all known series in Prometheus
+text format for the /admin/metrics handler.
+
+"""
+
+import collections
+import functools
+import os
+import threading
+import time
+
+import webapp2
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+
+from requestcontext import RequestContext
+
+METRICS_NAMESPACE = 'metrics'
+METRICS_SERIES_KEY = 'METRICS_SERIES'
+FLUSH_INTERVAL_SECONDS = 60
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# re-encoding a response to measure it costs CPU; only do it every Nth call
+PAYLOAD_SAMPLE_EVERY = 10
+
+METRIC_TYPES = collections.OrderedDict([
+    ('conference_requests_total', ('counter', 'Calls per endpoint.')),
+    ('conference_request_errors_total', ('counter',
+                                         'Calls that raised, per endpoint.')),
+    ('conference_request_latency_ms', ('histogram',
+                                       'Call latency per endpoint.')),
+    ('conference_request_rpcs_total', ('counter',
+                                       'API RPCs made per endpoint/service.')),
+    ('conference_request_bytes', ('summary', 'Request payload size.')),
+    ('conference_response_bytes', ('summary',
+                                   'Sampled response payload size.')),
+    ('conference_tenant_requests_total', ('counter',
+                                          'Calls per tenant (quota).')),
+    ('conference_tenant_rpcs_total', ('counter',
+                                      'API RPCs per tenant/service (quota).')),
+])
+
+_lock = threading.Lock()
+_pending = collections.Counter()
+_published = set()
+_lastFlush = [time.time()]
+_calls = [0]
+
+
+def series(metric, **labels):
+    """Return the Prometheus series name for a metric and its labels."""
+    if not labels:
+        return metric
+    return '%s{%s}' % (metric, ','.join(
+        '%s="%s"' % (k, labels[k]) for k in sorted(labels)))
+
+
+def increment(metric, delta=1, **labels):
+    """Add delta to a counter series; flushed with everything else."""
+    with _lock:
+        _pending[series(metric, **labels)] += delta
+
+
+def observe(endpoint, elapsed_ms, stats, request_bytes, response_bytes,
+            error):
+    """Record one instrumented call."""
+    tenant = namespace_manager.get_namespace() or 'default'
+    with _lock:
+        _pending[series('conference_requests_total', endpoint=endpoint)] += 1
+        if error:
+            _pending[series('conference_request_errors_total',
+                            endpoint=endpoint, error=error)] += 1
+        name = 'conference_request_latency_ms'
+        for le in LATENCY_BUCKETS_MS:
+            if elapsed_ms <= le:
+                _pending[series(name + '_bucket', endpoint=endpoint,
+                                le=le)] += 1
+        _pending[series(name + '_bucket', endpoint=endpoint, le='+Inf')] += 1
+        _pending[series(name + '_sum', endpoint=endpoint)] += int(elapsed_ms)
+        _pending[series(name + '_count', endpoint=endpoint)] += 1
+        for service, count in stats.services.iteritems():
+            _pending[series('conference_request_rpcs_total',
+                            endpoint=endpoint, service=service)] += count
+            _pending[series('conference_tenant_rpcs_total',
+                            tenant=tenant, service=service)] += count
+        _pending[series('conference_tenant_requests_total',
+                        tenant=tenant)] += 1
+        for name, size in (('conference_request_bytes', request_bytes),
+                           ('conference_response_bytes', response_bytes)):
+            if size is not None:
+                _pending[series(name + '_sum', endpoint=endpoint)] += size
+                _pending[series(name + '_count', endpoint=endpoint)] += 1
+    if time.time() - _lastFlush[0] > FLUSH_INTERVAL_SECONDS:
+        flush()
+
+
+def flush():
+    """Add this instance's pending deltas to the shared memcache counters."""
+    with _lock:
+        deltas = dict(_pending)
+        _pending.clear()
+        _lastFlush[0] = time.time()
+        new_series = set(deltas) - _published
+        _published.update(new_series)
+    if deltas:
+        memcache.offset_multi(deltas, initial_value=0,
+                              namespace=METRICS_NAMESPACE)
+    if new_series:
+        _publishSeries(new_series)
+
+
+def _publishSeries(new_series):
+    """Add series names to the shared registry read by exposition()."""
+    client = memcache.Client()
+    for _ in range(3):
+        known = client.gets(METRICS_SERIES_KEY, namespace=METRICS_NAMESPACE)
+        if known is None:
+            if client.add(METRICS_SERIES_KEY, set(new_series),
+                          namespace=METRICS_NAMESPACE):
+                return
+            continue
+        if new_series <= known:
+            return
+        if client.cas(METRICS_SERIES_KEY, known | new_series,
+                      namespace=METRICS_NAMESPACE):
+            return
+
+
+def exposition():
+    """Render every known series in Prometheus text format."""
+    flush()
+    names = sorted(memcache.get(METRICS_SERIES_KEY,
+                                namespace=METRICS_NAMESPACE) or ())
+    values = memcache.get_multi(names, namespace=METRICS_NAMESPACE)
+    lines = []
+    for metric, (kind, help_text) in METRIC_TYPES.iteritems():
+        rows = [n for n in names if n.split('{')[0] == metric or
+                n.split('{')[0].rsplit('_', 1)[0] == metric]
+        if not rows:
+            continue
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        lines.extend('%s %s' % (n, values.get(n, 0)) for n in rows)
+    # ad hoc counters added through increment()
+    typed = set(METRIC_TYPES)
+    for n in names:
+        base = n.split('{')[0]
+        if base not in typed and base.rsplit('_', 1)[0] not in METRIC_TYPES:
+            lines.append('%s %s' % (n, values.get(n, 0)))
+    return '\n'.join(lines) + '\n'
+
+
+def _responseBytes(handler, result):
+    """Size of what the call returned, on every Nth call."""
+    _calls[0] += 1
+    if _calls[0] % PAYLOAD_SAMPLE_EVERY:
+        return None
+    if isinstance(handler, webapp2.RequestHandler):
+        return len(handler.response.body)
+    return len(protojson.encode_message(result)) if result else 0
+
+
+def instrumented(fn):
+    """Decorate an endpoint or handler method to record its metrics.
+
+    Endpoints are labelled with the method name (they are unique within
+    ConferenceApi); handler methods with 'HandlerClass.method'. The call
+    runs inside its own requestcontext.RequestContext.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if isinstance(self, webapp2.RequestHandler):
+            endpoint = '%s.%s' % (type(self).__name__, fn.__name__)
+        else:
+            endpoint = fn.__name__
+        request_bytes = int(os.environ.get('CONTENT_LENGTH') or 0)
+        error = None
+        result = None
+        started = time.time()
+        # one RequestContext per call; its RpcStats feed the metrics
+        with RequestContext() as context:
+            try:
+                result = fn(self, *args, **kwargs)
+                return result
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                observe(endpoint, (time.time() - started) * 1000,
+                        context.stats, request_bytes,
+                        _responseBytes(self, result), error)
+    return wrapper
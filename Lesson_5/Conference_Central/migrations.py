@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+migrations.py -- Udacity conference server-side Python App Engine
+    resumable batch schema migrations
+
+A migration is a function registered with @migration against a model. It
+receives one batch of entities and returns the ones that must be written
+back. Batches are walked with cursors by a chain of tasks (see
+taskchain.py); after each batch the cursor is checkpointed in a
+MigrationStatus entity, so a
+failed or restarted task resumes from the last completed batch (which
+means migration functions must be safe to run twice on an entity).
+
+The batch read is not transactional, so writes do not reuse it: each
+entity to write gets its own small transaction, which re-reads the
+entity it came from and runs the migration on that fresh copy. A
+registration committed since the batch read is therefore kept, not
+overwritten.
+
+"""
+
+import functools
+import time
+
+from google.appengine.ext import ndb
+
+from models import Attendee
+from models import Conference
+from models import ConferenceSession
+from models import MigrationStatus
+from models import Profile
+from models import SessionWishlist
+from taskchain import chainBatch
+from taskchain import checkpoint
+from taskchain import pageCursor
+from taskchain import runBatch
+
+MIGRATIONS = {}
+MIGRATION_BATCH_SIZE = 100
+# upper bound on entities written per second by one migration
+MIGRATION_MAX_WRITES_PER_SECOND = 50
+
+MIGRATION_QUERY_OPTIONS = {'use_cache': False, 'use_memcache': False}
+MIGRATION_URL = '/tasks/run_migration'
+
+
+def migration(name, model, batch_size=MIGRATION_BATCH_SIZE):
+    """Register fn(entities) -> entities to put, under a unique name."""
+    def decorator(fn):
+        MIGRATIONS[name] = (model, fn, batch_size)
+        return fn
+    return decorator
+
+
+def _enqueueBatch(status, countdown=0):
+    """Chain the task for the next batch."""
+    name = status.key.id()
+    chainBatch(status, MIGRATION_URL, 'migrate-%s' % name, {'name': name},
+               countdown)
+
+
+def startMigration(name):
+    """(Re)start a registered migration from the beginning."""
+    if name not in MIGRATIONS:
+        raise KeyError('No migration registered as %s' % name)
+    status = MigrationStatus(id=name, kind=MIGRATIONS[name][0]._get_kind(),
+                             runId=int(time.time()))
+    status.put()
+    _enqueueBatch(status)
+    return status
+
+
+def _migrateOne(fn, source_key, key):
+    """Re-run fn on a fresh copy of source and put its entity for key."""
+    source = source_key.get(**MIGRATION_QUERY_OPTIONS)
+    for out in fn([source] if source else []) or []:
+        if out.key == key:
+            out.put(**MIGRATION_QUERY_OPTIONS)
+            return 1
+    return 0
+
+
+def runMigrationBatch(name, run_id, batch):
+    """Migrate one batch, checkpoint it and chain the next batch."""
+    status = MigrationStatus.get_by_id(name)
+    if not runBatch(status, run_id, batch, MIGRATION_URL,
+                    'migrate-%s' % name, {'name': name}):
+        return
+    model, fn, batch_size = MIGRATIONS[name]
+    started = time.time()
+
+    entities, cursor, more = model.query().fetch_page(
+        batch_size, start_cursor=pageCursor(status),
+        **MIGRATION_QUERY_OPTIONS)
+    # one at a time: conferences share their organizer's entity group,
+    # so concurrent transactions would contend with each other
+    written = 0
+    for entity in entities:
+        for out in fn([entity]) or []:
+            written += ndb.transaction(
+                functools.partial(_migrateOne, fn, entity.key, out.key),
+                xg=out.key.root() != entity.key.root())
+
+    status = checkpoint(status, cursor, more, processed=len(entities),
+                        written=written)
+    if status and not status.done:
+        # stretch the chain so writes stay under the configured rate
+        countdown = max(0, written / float(MIGRATION_MAX_WRITES_PER_SECOND)
+                        - (time.time() - started))
+        _enqueueBatch(status, countdown)
+
+
+def migrationReport():
+    """Return progress of every registered migration as a list of dicts."""
+    statuses = ndb.get_multi(
+        [ndb.Key(MigrationStatus, name) for name in sorted(MIGRATIONS)])
+    report = []
+    for name, status in zip(sorted(MIGRATIONS), statuses):
+        entry = {'name': name, 'kind': MIGRATIONS[name][0]._get_kind()}
+        if status:
+            entry.update(processed=status.processed,
+                         written=status.written,
+                         batches=status.batches,
+                         done=status.done,
+                         started=str(status.started),
+                         updated=str(status.updated))
+        report.append(entry)
+    return report
+
+# - - - Registered migrations - - - - - - - - - - - - - - - -
+
+
+@migration('conference_month', Conference)
+def recomputeConferenceMonth(conferences):
+    """Re-put conferences so the computed month property is re-indexed."""
+    return [c for c in conferences if c.startDate]
+
+
+@migration('conference_sync_timestamps', Conference)
+def stampConferences(conferences):
+    """Re-put conferences so they get the created/updated timestamps."""
+    return [c for c in conferences if c.updated is None and c.startDate]
+
+
+@migration('session_sync_timestamps', ConferenceSession)
+def stampSessions(sessions):
+    """Re-put sessions so they get the created/updated timestamps."""
+    return [s for s in sessions if s.updated is None]
+
+
+# re-putting an entity rewrites its index rows, dropping the ones for
+# properties that are now indexed=False
+@migration('unindex_conferences', Conference)
+def unindexConferences(conferences):
+    return [c for c in conferences if c.startDate]
+
+
+@migration('unindex_sessions', ConferenceSession)
+def unindexSessions(sessions):
+    return sessions
+
+
+@migration('unindex_profiles', Profile)
+def unindexProfiles(profiles):
+    return profiles
+
+
+@migration('unindex_wishlists', SessionWishlist)
+def unindexWishlists(wishlists):
+    return wishlists
+
+
+# descriptions written before they became compressed TextProperties are
+# stored as plain strings; re-putting compresses them
+@migration('compress_descriptions', Conference)
+def compressDescriptions(conferences):
+    return [c for c in conferences if c.description and c.startDate]
+
+
+@migration('attendee_index', Profile)
+def indexAttendees(profiles):
+    """Create the Attendee reverse index from existing registrations."""
+    return [Attendee(parent=ndb.Key(urlsafe=wsck), id=p.key.id(),
+                     displayName=p.displayName)
+            for p in profiles for wsck in p.conferenceKeysToAttend]
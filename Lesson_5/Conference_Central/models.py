@@ -21,12 +21,17 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 429 response"""
+    http_status = 429   # not in httplib
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
-    displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # never queried: no index rows (see the unindex_* migrations)
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True, indexed=False)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -50,16 +55,24 @@ class StringMessage(messages.Message):
 
 class Conference(ndb.Model):
     """Conference -- Conference object"""
+    # indexed: name (sort), the FIELDS filters (topics, city, month,
+    # maxAttendees), seatsAvailable (announcement) and updated (sync)
     name            = ndb.StringProperty(required=True)
-    description     = ndb.StringProperty()
-    organizerUserId = ndb.StringProperty()
+    # zlib-compressed on write, decompressed on first access
+    description     = ndb.TextProperty(compressed=True)
+    organizerUserId = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
-    startDate       = ndb.DateProperty()
+    startDate       = ndb.DateProperty(indexed=False)
     month           = ndb.ComputedProperty(lambda self: self.startDate.month)
-    endDate         = ndb.DateProperty()
+    endDate         = ndb.DateProperty(indexed=False)
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # bumped by every updateConference; compare-and-set guard
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+    # set on every put(); queried by getChangesSince()
+    created         = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -75,10 +88,14 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    version         = messages.IntegerField(13)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    # set when a listing hit its deadline (see listings.py)
+    partial = messages.BooleanField(2)
+    stale = messages.BooleanField(3)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -107,18 +124,24 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    includeDescription = messages.BooleanField(2)
 
 class Speaker(ndb.Model):
     name = ndb.StringProperty(required=True)
 
 class ConferenceSession(ndb.Model):
-    name = ndb.StringProperty(required=True)
+    # indexed: speakers.name, highlights, type, start_time (sort), updated
+    name = ndb.StringProperty(required=True, indexed=False)
     speakers = ndb.StructuredProperty(Speaker, repeated=True)
     highlights = ndb.StringProperty(repeated=True)
-    date = ndb.DateProperty()
+    date = ndb.DateProperty(indexed=False)
     start_time = ndb.TimeProperty()
-    duration_in_minutes = ndb.IntegerProperty()
+    duration_in_minutes = ndb.IntegerProperty(indexed=False)
     type = ndb.StringProperty()
+    description = ndb.TextProperty(compressed=True)
+    # set on every put(); queried by getChangesSince()
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 class ConferenceSessionForm(messages.Message):
     """ConferenceSessionForm"""
@@ -130,12 +153,133 @@ class ConferenceSessionForm(messages.Message):
     duration_in_minutes = messages.IntegerField(6)
     type = messages.StringField(7)
     parent_key = messages.StringField(8)
+    websafeKey = messages.StringField(9)
+    description = messages.StringField(10)
 
 class ConferenceSessionForms(messages.Message):
     items = messages.MessageField(ConferenceSessionForm, 1, repeated=True)
+    partial = messages.BooleanField(2)
+    stale = messages.BooleanField(3)
+
+class Attendee(ndb.Model):
+    """Attendee -- registration reverse index, child of its Conference
+
+    Keyed by the attendee's user id. displayName is indexed for projection
+    queries.
+    """
+    displayName = ndb.StringProperty()
+    registered  = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- one registered attendee"""
+    userId      = messages.StringField(1)
+    displayName = messages.StringField(2)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- one page of a conference's attendees"""
+    items      = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    more       = messages.BooleanField(3)
+
+class Tombstone(ndb.Model):
+    """Tombstone -- marks a deleted entity (keyed by its urlsafe key) for sync"""
+    kind    = ndb.StringProperty(indexed=False)
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- entities changed/deleted since a sync token"""
+    conferences = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sessions    = messages.MessageField(ConferenceSessionForm, 2, repeated=True)
+    deletedKeys = messages.StringField(3, repeated=True)
+    syncToken   = messages.StringField(4)
+    more        = messages.BooleanField(5)
 
 class SessionWishlist(ndb.Model):
-    session_keys = ndb.StringProperty(repeated=True)
+    session_keys = ndb.StringProperty(repeated=True, indexed=False)
 
 class SessionWishlistForm(messages.Message):
-    session_key = messages.StringField(1)
\ No newline at end of file
+    session_key = messages.StringField(1)
+class ExportShard(ndb.Model):
+    """ExportShard -- one NDJSON file written by a chained export task"""
+    exportId = ndb.StringProperty(required=True)
+    sequence = ndb.IntegerProperty(required=True, indexed=False)
+    data     = ndb.TextProperty(compressed=True)
+    created  = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class FacetCount(ndb.Model):
+    """FacetCount -- conferences and seats sold per facet value
+
+    Keyed '<facet>:<value>', e.g. 'city:London' (see facets.py).
+    """
+    facet       = ndb.StringProperty(indexed=False)
+    value       = ndb.StringProperty(indexed=False)
+    conferences = ndb.IntegerProperty(default=0, indexed=False)
+    seatsSold   = ndb.IntegerProperty(default=0, indexed=False)
+
+class ChainStatus(ndb.Model):
+    """ChainStatus -- checkpoint of a cursor-chained task run (taskchain.py)"""
+    runId   = ndb.IntegerProperty(indexed=False)
+    cursor  = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    done    = ndb.BooleanProperty(default=False, indexed=False)
+
+class FacetRebuild(ChainStatus):
+    """FacetRebuild -- checkpoint of the nightly facet recount"""
+    # [urlsafe key of its last conference, read time] per batch
+    reads    = ndb.JsonProperty(compressed=True)
+    counts   = ndb.JsonProperty(compressed=True)
+    # deltas for conferences counted before the delta was applied
+    pending  = ndb.JsonProperty(compressed=True)
+    # deltas for conferences no batch has reached yet
+    held     = ndb.JsonProperty(compressed=True)
+    swapping = ndb.BooleanProperty(default=False, indexed=False)
+
+class FacetForm(messages.Message):
+    """FacetForm -- one facet value and its counts"""
+    facet       = messages.StringField(1)
+    value       = messages.StringField(2)
+    conferences = messages.IntegerField(3)
+    seatsSold   = messages.IntegerField(4)
+
+class FacetForms(messages.Message):
+    """FacetForms -- counts for every city, topic and month"""
+    items = messages.MessageField(FacetForm, 1, repeated=True)
+
+class SeatReconcile(ChainStatus):
+    """SeatReconcile -- checkpoint of the seat-count reconciliation"""
+    checked = ndb.IntegerProperty(default=0, indexed=False)
+    drifted = ndb.IntegerProperty(default=0, indexed=False)
+    fixed   = ndb.IntegerProperty(default=0, indexed=False)
+    skipped = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ImportStatus(ChainStatus):
+    """ImportStatus -- checkpoint of a chunked bulk import (bulkload.py)"""
+    # 'conferences', then 'sessions': each walks every chunk
+    phase       = ndb.StringProperty(indexed=False)
+    notify      = ndb.BooleanProperty(default=False, indexed=False)
+    chunks      = ndb.IntegerProperty(default=0, indexed=False)
+    # '_ref' of each imported conference -> its urlsafe key
+    refs        = ndb.JsonProperty(compressed=True)
+    conferences = ndb.IntegerProperty(default=0, indexed=False)
+    sessions    = ndb.IntegerProperty(default=0, indexed=False)
+    skipped     = ndb.IntegerProperty(default=0, indexed=False)
+    tasks       = ndb.IntegerProperty(default=0, indexed=False)
+    started     = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated     = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ImportChunk(ndb.Model):
+    """ImportChunk -- NDJSON lines for one import task, child of ImportStatus"""
+    data        = ndb.TextProperty(compressed=True)
+    # urlsafe keys allocated for the chunk's new entities, per phase,
+    # so a retried task writes the same entities again
+    keys        = ndb.JsonProperty(compressed=True)
+
+class MigrationStatus(ChainStatus):
+    """MigrationStatus -- checkpoint of a running migration, keyed by name"""
+    kind      = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written   = ndb.IntegerProperty(default=0, indexed=False)
+    started   = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated   = ndb.DateTimeProperty(auto_now=True, indexed=False)
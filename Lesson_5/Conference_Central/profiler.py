@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+profiler.py -- Udacity conference server-side Python App Engine
+    on-demand cProfile capture of single admin requests
+
+Requests carrying an 'X-Profile' header from an admin run under cProfile;
+the sorted pstats report and the raw (zlib-compressed, marshalled) stats
+are stored in memcache and listed by the /admin/profiles handler. Other
+requests only pay for one dict lookup.
+
+"""
+
+import cProfile
+import marshal
+import pstats
+import re
+import time
+import zlib
+from cStringIO import StringIO
+
+from google.appengine.api import memcache
+
+PROFILE_TRIGGER_HEADER = 'HTTP_X_PROFILE'
+PROFILE_NAMESPACE = 'profiles'
+PROFILE_INDEX_KEY = 'PROFILES'
+PROFILE_KEEP = 20
+PROFILE_TTL_SECONDS = 24 * 60 * 60
+PROFILE_REPORT_LINES = 60
+
+
+def _isAdmin():
+    """Admin by cookie login (handlers) or by OAuth token (endpoints)."""
+    from google.appengine.api import oauth
+    from google.appengine.api import users
+    if users.is_current_user_admin():
+        return True
+    try:
+        return oauth.is_current_user_admin(
+            'https://www.googleapis.com/auth/userinfo.email')
+    except oauth.Error:
+        return False
+
+
+def _store(environ, profile):
+    """Save the report and raw stats; return the profile id."""
+    report = StringIO()
+    stats = pstats.Stats(profile, stream=report)
+    stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    profile.create_stats()
+
+    path = environ.get('PATH_INFO', '')
+    profile_id = '%d-%s' % (time.time() * 1000,
+                            re.sub(r'[^\w.]+', '_', path).strip('_'))
+    memcache.set(profile_id, {
+        'path': path,
+        'created': time.time(),
+        'report': report.getvalue(),
+        'pstats': zlib.compress(marshal.dumps(profile.stats)),
+    }, time=PROFILE_TTL_SECONDS, namespace=PROFILE_NAMESPACE)
+
+    client = memcache.Client()
+    for _ in range(3):
+        ids = client.gets(PROFILE_INDEX_KEY, namespace=PROFILE_NAMESPACE)
+        if ids is None:
+            if client.add(PROFILE_INDEX_KEY, [profile_id],
+                          namespace=PROFILE_NAMESPACE):
+                break
+            continue
+        if client.cas(PROFILE_INDEX_KEY, ([profile_id] + ids)[:PROFILE_KEEP],
+                      namespace=PROFILE_NAMESPACE):
+            break
+    return profile_id
+
+
+def recentProfiles():
+    """Return [(profile id, path)] of stored profiles, newest first."""
+    ids = memcache.get(PROFILE_INDEX_KEY, namespace=PROFILE_NAMESPACE) or []
+    found = memcache.get_multi(ids, namespace=PROFILE_NAMESPACE)
+    return [(i, found[i]['path']) for i in ids if i in found]
+
+
+def getProfile(profile_id):
+    """Return a stored profile dict, or None."""
+    return memcache.get(profile_id, namespace=PROFILE_NAMESPACE)
+
+
+def profiling_wsgi_middleware(app):
+    """Wrap a WSGI app so triggered admin requests are profiled."""
+    def profiled_app(environ, start_response):
+        if PROFILE_TRIGGER_HEADER not in environ or not _isAdmin():
+            return app(environ, start_response)
+        profile = cProfile.Profile()
+        # consume the body inside the profiler so lazy apps are measured
+        body = profile.runcall(
+            lambda: list(app(environ, start_response)))
+        _store(environ, profile)
+        return body
+    return profiled_app
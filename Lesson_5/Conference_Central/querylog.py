@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+querylog.py -- Udacity conference server-side Python App Engine
+    slow-query log for ndb queries
+
+loggedFetch()/loggedFetchPage() run a query exactly like fetch() and
+fetch_page() do; boundedFetch() stops at a deadline instead of failing.
+
+Queries slower than SLOW_QUERY_MS or returning more than
+SLOW_QUERY_RESULTS entities are logged with their normalized filters
+(values replaced by '?'), sort orders, result count, cursors and the
+index.yaml entry that serves them. The worst SLOW_QUERY_KEEP entries are
+kept in a memcache ring buffer shown by /admin/slow_queries.
+
+"""
+
+import logging
+import os
+import time
+
+import yaml
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+SLOW_QUERY_MS = 200
+SLOW_QUERY_RESULTS = 500
+SLOW_QUERY_KEEP = 50
+SLOW_QUERY_KEY = 'SLOW_QUERIES'
+BOUNDED_BATCH_SIZE = 100
+INDEX_YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'index.yaml')
+
+_indexes = []
+
+
+def _filters(node):
+    """Flatten a query filter tree into (property, operator) pairs."""
+    if node is None:
+        return []
+    if isinstance(node, ndb.query.FilterNode):
+        return [(node._FilterNode__name, node._FilterNode__opsymbol)]
+    if isinstance(node, (ndb.query.ConjunctionNode,
+                         ndb.query.DisjunctionNode)):
+        pairs = []
+        for child in node:
+            pairs.extend(p for p in _filters(child) if p not in pairs)
+        return pairs
+    return [(repr(node), '?')]
+
+
+def _orders(query):
+    """Return [(property, 'asc'|'desc')] for a query's sort orders."""
+    orders = query.orders
+    if orders is None:
+        return []
+    if isinstance(orders, datastore_query.CompositeOrder):
+        orders = orders.orders
+    else:
+        orders = [orders]
+    return [(o.prop, 'desc' if o.direction == o.DESCENDING else 'asc')
+            for o in orders]
+
+
+def _loadIndexes():
+    """Parse index.yaml once per instance."""
+    if not _indexes:
+        with open(INDEX_YAML) as f:
+            _indexes.extend((yaml.safe_load(f) or {}).get('indexes') or [])
+    return _indexes
+
+
+def _projection(projection):
+    """Property names of a projection given as names or properties."""
+    return [getattr(p, '_name', p) for p in projection or []]
+
+
+def matchingIndex(kind, filters, orders, ancestor, projection=()):
+    """Return the index.yaml entry serving a query, 'built-in' or None."""
+    equality = set(p for p, op in filters if op == '=')
+    inequality = [p for p, op in filters if op != '=']
+    rest = []
+    for prop in inequality[:1] + [p for p, _ in orders]:
+        if prop not in rest:
+            rest.append(prop)
+    # projected properties must be in the index too, after the others
+    extra = set(projection) - equality - set(rest)
+    if (len(equality) + len(rest) + len(extra) <= 1 and
+            not (ancestor and (rest or extra))):
+        return 'built-in'
+    if not rest and not extra and not ancestor:
+        return 'built-in'        # equality-only: merge join on built-ins
+    for index in _loadIndexes():
+        props = [p['name'] for p in index.get('properties') or []]
+        ordered = len(equality) + len(rest)
+        if (index.get('kind') == kind and
+                bool(index.get('ancestor')) == bool(ancestor) and
+                set(props[:len(equality)]) == equality and
+                props[len(equality):ordered] == rest and
+                set(props[ordered:]) == extra and
+                len(props) == ordered + len(extra)):
+            return index
+    return None
+
+
+def _record(entry):
+    """Add an entry to the ring buffer of the worst queries."""
+    client = memcache.Client()
+    for _ in range(3):
+        worst = client.gets(SLOW_QUERY_KEY)
+        if worst is None:
+            if client.add(SLOW_QUERY_KEY, [entry]):
+                return
+            continue
+        worst = sorted(worst + [entry], key=lambda e: -e['elapsed_ms'])
+        if client.cas(SLOW_QUERY_KEY, worst[:SLOW_QUERY_KEEP]):
+            return
+
+
+def _check(name, query, elapsed, count, start_cursor=None, end_cursor=None,
+           projection=None):
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms < SLOW_QUERY_MS and count <= SLOW_QUERY_RESULTS:
+        return
+    filters = _filters(query.filters)
+    orders = _orders(query)
+    projection = _projection(projection or query.projection)
+    entry = {
+        'name': name,
+        'kind': query.kind,
+        'ancestor': query.ancestor is not None,
+        'filters': ['%s %s ?' % f for f in filters],
+        'orders': ['%s %s' % o for o in orders],
+        'projection': projection,
+        'results': count,
+        'elapsed_ms': round(elapsed_ms, 1),
+        'start_cursor': start_cursor.urlsafe() if start_cursor else None,
+        'end_cursor': end_cursor.urlsafe() if end_cursor else None,
+        'index': matchingIndex(query.kind, filters, orders,
+                               query.ancestor is not None, projection),
+        'time': time.time(),
+    }
+    logging.warning('slow query: %r', entry)
+    _record(entry)
+
+
+def loggedFetch(query, name, **options):
+    """query.fetch(**options), logged if slow or large."""
+    started = time.time()
+    results = query.fetch(**options)
+    _check(name, query, time.time() - started, len(results),
+           projection=options.get('projection'))
+    return results
+
+
+def loggedFetchPage(query, name, page_size, **options):
+    """query.fetch_page(page_size, **options), logged if slow or large."""
+    started = time.time()
+    results, cursor, more = query.fetch_page(page_size, **options)
+    _check(name, query, time.time() - started, len(results),
+           options.get('start_cursor'), cursor, options.get('projection'))
+    return results, cursor, more
+
+
+def boundedFetch(query, name, deadline, **options):
+    """Fetch for at most deadline seconds; return (results, complete).
+
+    Each datastore RPC gets deadline as its own deadline. When one times
+    out, or time runs out between batches, the results read so far are
+    returned with complete=False.
+    """
+    started = time.time()
+    results = []
+    complete = True
+    try:
+        for result in query.iter(batch_size=BOUNDED_BATCH_SIZE,
+                                 deadline=deadline, **options):
+            results.append(result)
+            if time.time() - started > deadline:
+                complete = False
+                break
+    except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError):
+        complete = False
+    _check(name, query, time.time() - started, len(results),
+           projection=options.get('projection'))
+    return results, complete
+
+
+def slowQueries():
+    """Return the worst logged queries, slowest first."""
+    return memcache.get(SLOW_QUERY_KEY) or []
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- Udacity conference server-side Python App Engine
+    per-caller admission control for ConferenceApi methods
+
+@rateLimited wraps ConferenceApi methods (below @instrumented). A method
+listed in RATE_LIMITS as (calls, seconds) admits that many calls per
+caller in every window of that many seconds. A caller is the signed-in
+user, or the client IP address for anonymous calls. Callers over the limit
+get TooManyRequestsException (429).
+
+Each check is a single memcache.incr on a key naming the method, caller
+and window, so the bucket refills when the next window starts. Old
+windows are never read again and simply age out of memcache. If memcache
+is unavailable, calls are let through.
+
+"""
+
+import functools
+import os
+import time
+
+from google.appengine.api import memcache
+
+from metrics import METRIC_TYPES
+from metrics import increment
+from models import TooManyRequestsException
+from requestcontext import current
+
+# method name -> (calls, per seconds); methods not listed are unlimited
+RATE_LIMITS = {
+    'queryConferences':                    (30, 60),
+    'getConferenceSessionsByFilters':      (30, 60),
+    'getConferencesWithSessionHighlights': (30, 60),
+    'getConferenceSessionsByHighlight':    (60, 60),
+    'getSessionsBySpeaker':                (60, 60),
+    'getChangesSince':                     (60, 60),
+}
+
+METRIC_TYPES['conference_rate_limited_total'] = (
+    'counter', 'Calls refused with 429, per endpoint.')
+
+
+def _caller(service):
+    """'u:<user id>' for signed-in callers, 'ip:<address>' otherwise."""
+    ctx = current()
+    if ctx.user:
+        return 'u:' + ctx.userId
+    state = getattr(service, 'request_state', None)
+    address = getattr(state, 'remote_address', None)
+    return 'ip:' + (address or os.environ.get('REMOTE_ADDR', ''))
+
+
+def admit(method, caller):
+    """Count one call; return False if caller is over method's limit."""
+    calls, seconds = RATE_LIMITS[method]
+    window = int(time.time() // seconds)
+    # the tenant's namespace applies, so limits are per tenant too
+    count = memcache.incr('RATE:%s:%s:%d' % (method, caller, window),
+                          initial_value=0)
+    return count is None or count <= calls
+
+
+def rateLimited(fn):
+    """Decorate a ConferenceApi method to enforce RATE_LIMITS."""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if fn.__name__ in RATE_LIMITS and not admit(fn.__name__,
+                                                    _caller(self)):
+            increment('conference_rate_limited_total', endpoint=fn.__name__)
+            raise TooManyRequestsException(
+                'Too many requests; try again later.')
+        return fn(self, *args, **kwargs)
+    return wrapper
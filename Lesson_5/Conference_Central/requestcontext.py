@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+requestcontext.py -- Udacity conference server-side Python App Engine
+    per-call memo of the current user, user id, Profile and entity gets
+
+@instrumented opens one RequestContext around every endpoint call;
+helpers reach it with current():
+
+    ctx = current()
+    user = ctx.requireUser()     # endpoints.get_current_user(), once
+    prof = yield ctx.profileAsync()
+
+getAsync() hands every helper asking for the same key the same future,
+and keys asked for before the event loop runs go out in one autobatched
+get. Memoized futures belong to the request, not to a transaction:
+transactional code must get its own entities.
+
+"""
+
+import threading
+
+import endpoints
+from google.appengine.ext import ndb
+
+from models import Profile
+from rpcstats import RpcStats
+from utils import getUserId
+
+_local = threading.local()
+_UNSET = object()
+
+
+class RequestContext(object):
+    """RequestContext -- memoized auth and gets for one endpoint call"""
+
+    def __init__(self):
+        self.stats = RpcStats()
+        self._user = _UNSET
+        self._userId = None
+        self._futures = {}
+
+    @property
+    def user(self):
+        """The signed-in user, or None."""
+        if self._user is _UNSET:
+            self._user = endpoints.get_current_user()
+        return self._user
+
+    def requireUser(self):
+        """Return the signed-in user; 401 if there is none."""
+        if not self.user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self.user
+
+    @property
+    def userId(self):
+        if self._userId is None:
+            self._userId = getUserId(self.requireUser())
+        return self._userId
+
+    @property
+    def profileKey(self):
+        return ndb.Key(Profile, self.userId)
+
+    def getAsync(self, key):
+        """Memoized key.get_async()."""
+        if key not in self._futures:
+            self._futures[key] = key.get_async()
+        return self._futures[key]
+
+    def getMultiAsync(self, keys):
+        return [self.getAsync(key) for key in keys]
+
+    def profileAsync(self):
+        """Future for the current user's Profile (None if not saved yet)."""
+        return self.getAsync(self.profileKey)
+
+    def remember(self, entity):
+        """Serve later gets of entity.key from entity (e.g. after a put)."""
+        future = ndb.Future()
+        future.set_result(entity)
+        self._futures[entity.key] = future
+
+    def __enter__(self):
+        self.stats.__enter__()
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack.remove(self)
+        self.stats.__exit__(*exc_info)
+
+
+def current():
+    """The innermost open RequestContext, or a fresh unopened one."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else RequestContext()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+rpcstats.py -- Udacity conference server-side Python App Engine
+    per-thread counting of API (datastore, memcache, ...) RPCs
+
+    with RpcStats() as stats:
+        ...
+    stats.services['datastore_v3']  # -> number of datastore RPCs
+    stats.writeOps['index_writes']  # -> index rows written by puts/deletes
+                                    #    and transaction commits
+
+RpcStats blocks may be nested; every active block on the calling thread
+sees each RPC made on that thread.
+
+"""
+
+import collections
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+
+_local = threading.local()
+
+
+class RpcStats(object):
+    """RpcStats -- RPC counts per service and per service.method"""
+
+    def __init__(self):
+        self.services = collections.Counter()
+        self.calls = collections.Counter()
+        self.writeOps = collections.Counter()
+
+    def record(self, service, call):
+        self.services[service] += 1
+        self.calls['%s.%s' % (service, call)] += 1
+
+    @property
+    def total(self):
+        return sum(self.services.itervalues())
+
+    def recordCost(self, cost):
+        self.writeOps['entity_writes'] += cost.entity_writes()
+        self.writeOps['index_writes'] += cost.index_writes()
+
+    def toDict(self):
+        return {'services': dict(self.services), 'calls': dict(self.calls),
+                'writeOps': dict(self.writeOps)}
+
+    def __enter__(self):
+        install()
+        if not hasattr(_local, 'active'):
+            _local.active = []
+        _local.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.active.remove(self)
+
+
+def _preCallHook(service, call, request, response):
+    for stats in getattr(_local, 'active', ()):
+        stats.record(service, call)
+
+
+def _postCallHook(service, call, request, response):
+    # transactional writes are costed once, on the Commit response
+    if call in ('Put', 'Delete') and request.has_transaction():
+        return
+    if call in ('Put', 'Delete', 'Commit') and response.has_cost():
+        for stats in getattr(_local, 'active', ()):
+            stats.recordCost(response.cost())
+
+
+def install():
+    """Hook the current API proxy; a no-op if already hooked."""
+    # ListOfHooks ignores a second Append with the same key
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpcstats', _preCallHook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'rpcstats', _postCallHook, 'datastore_v3')
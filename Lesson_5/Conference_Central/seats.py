@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+seats.py -- Udacity conference server-side Python App Engine
+    nightly reconciliation of seatsAvailable against registrations
+
+seatsAvailable is kept up to date by registration, but owners can
+overwrite it (or maxAttendees) in updateConference, and it starts unset
+when maxAttendees is 0. This job recomputes it as
+
+    max(0, maxAttendees - number of Attendee children)
+
+A chain of tasks (see taskchain.py) walks the conferences with keys-only
+cursor pages, checkpointed in a SeatReconcile entity. Each batch reads its conferences
+first, then counts their attendees with keys-only ancestor counts. Only
+drifted conferences get a transaction. It re-reads just that conference
+and writes it only if `updated` is unchanged, so no registration happened
+since the count. Contended conferences are skipped with no retry, and the
+next run picks them up.
+
+Attendee children only exist for registrations made since they were
+introduced, or backfilled by the attendee_index migration. Until that
+migration has finished, counting them would free every older seat, so
+startReconcile() refuses to run.
+
+"""
+
+import collections
+import logging
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+
+from facets import enqueueDelta
+from facets import facetSnapshot
+from hotkeys import invalidate
+from metrics import METRIC_TYPES
+from metrics import increment
+from models import Attendee
+from models import Conference
+from models import MigrationStatus
+from models import SeatReconcile
+from taskchain import chainBatch
+from taskchain import checkpoint
+from taskchain import pageCursor
+from taskchain import runBatch
+
+SEAT_RECONCILE_URL = '/tasks/reconcile_seats'
+SEAT_RECONCILE_BATCH_SIZE = 100
+
+SEAT_QUERY_OPTIONS = {'use_cache': False, 'use_memcache': False}
+
+METRIC_TYPES['conference_seat_drift_total'] = (
+    'counter', 'Conferences whose seatsAvailable had drifted, per '
+               'tenant/direction (over/under/unset).')
+METRIC_TYPES['conference_seat_drift_seats_total'] = (
+    'counter', 'Seats by which seatsAvailable had drifted, per tenant.')
+METRIC_TYPES['conference_seat_fixes_skipped_total'] = (
+    'counter', 'Drifted conferences left for the next run, per tenant/reason.')
+
+
+def startReconcile():
+    """Start a reconciliation run from the first conference, or None."""
+    backfill = MigrationStatus.get_by_id('attendee_index')
+    if not (backfill and backfill.done):
+        logging.warning('seat reconciliation skipped: the attendee_index '
+                        'migration has not finished')
+        return None
+    status = SeatReconcile(id='seats', runId=int(time.time()))
+    status.put()
+    chainBatch(status, SEAT_RECONCILE_URL, 'seats')
+    return status
+
+
+def _fixSeats(conf_key, seen, seats):
+    """Set seatsAvailable unless the conference changed; in a transaction."""
+    conf = conf_key.get()
+    if conf is None or conf.updated != seen:
+        return False
+    before = facetSnapshot(conf)
+    conf.seatsAvailable = seats
+    conf.put()
+    queued = enqueueDelta(conf, before, facetSnapshot(conf),
+                          transactional=True)
+    if queued:
+        queued.get_result()
+    return True
+
+
+def _reconcile(conf, attendees, tally, tenant):
+    """Check one conference against its attendee count and fix any drift."""
+    seats = max(0, (conf.maxAttendees or 0) - attendees)
+    if conf.seatsAvailable == seats:
+        return
+    tally['drifted'] += 1
+    if conf.seatsAvailable is None:
+        direction = 'unset'
+    else:
+        direction = 'over' if conf.seatsAvailable > seats else 'under'
+    increment('conference_seat_drift_total', tenant=tenant,
+              direction=direction)
+    increment('conference_seat_drift_seats_total',
+              delta=abs((conf.seatsAvailable or 0) - seats), tenant=tenant)
+
+    # conferences without a startDate can't be put (see Conference.month)
+    reason = 'no_start_date'
+    if conf.startDate:
+        reason = 'changed'
+        try:
+            # no retries: a busy conference is left for the next run
+            if ndb.transaction(
+                    lambda: _fixSeats(conf.key, conf.updated, seats),
+                    retries=0):
+                tally['fixed'] += 1
+                invalidate(conf.key.urlsafe())
+                return
+        except datastore_errors.TransactionFailedError:
+            reason = 'contention'
+    tally['skipped'] += 1
+    increment('conference_seat_fixes_skipped_total', tenant=tenant,
+              reason=reason)
+
+
+def runReconcileBatch(run_id, batch):
+    """Reconcile one batch; return True once the run has finished."""
+    status = SeatReconcile.get_by_id('seats')
+    if not runBatch(status, run_id, batch, SEAT_RECONCILE_URL, 'seats'):
+        return False
+    tenant = namespace_manager.get_namespace() or 'default'
+
+    keys, cursor, more = Conference.query().fetch_page(
+        SEAT_RECONCILE_BATCH_SIZE, start_cursor=pageCursor(status),
+        keys_only=True, **SEAT_QUERY_OPTIONS)
+    # read the conferences before counting, so a registration in between
+    # shows up as a changed `updated` and the fix is skipped
+    conferences = ndb.get_multi(keys, **SEAT_QUERY_OPTIONS)
+    counts = [Attendee.query(ancestor=k).count_async(limit=None)
+              for k in keys]
+    tally = collections.Counter()
+    for conf, count in zip(conferences, counts):
+        if conf is not None:
+            tally['checked'] += 1
+            _reconcile(conf, count.get_result(), tally, tenant)
+
+    status = checkpoint(status, cursor, more, **tally)
+    if status is None:
+        return False
+    if status.done:
+        logging.info('seat reconciliation %d: %d checked, %d drifted, '
+                     '%d fixed, %d skipped', status.runId, status.checked,
+                     status.drifted, status.fixed, status.skipped)
+    else:
+        chainBatch(status, SEAT_RECONCILE_URL, 'seats')
+    return status.done
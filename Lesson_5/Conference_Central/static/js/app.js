@@ -130,3 +130,199 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+
+/**
+ * @ngdoc service
+ * @name conferenceData
+ *
+ * @description
+ * Client data layer in front of gapi.client.conference.
+ * Calls issued in the same tick are sent as one gapi.client.newBatch() request, read responses are
+ * cached per method/params for CACHE_TTL ms, served stale (and revalidated in the background) for up
+ * to STALE_FACTOR times that, and dropped when a mutation listed in INVALIDATES succeeds.
+ *
+ */
+app.factory('conferenceData', function () {
+    var conferenceData = {
+        /**
+         * Milliseconds a cached response of a read method is fresh.
+         */
+        CACHE_TTL: {
+            getProfile: 60000,
+            getConference: 30000,
+            getConferencesCreated: 30000,
+            getConferencesToAttend: 30000,
+            queryConferences: 30000,
+            getAnnouncement: 300000
+        },
+        STALE_FACTOR: 5,
+        /**
+         * Read methods whose cached responses a successful mutation makes obsolete.
+         */
+        INVALIDATES: {
+            saveProfile: ['getProfile'],
+            createConference: ['getConferencesCreated', 'queryConferences'],
+            updateConference: ['getConference', 'getConferencesCreated', 'queryConferences',
+                'getConferencesToAttend'],
+            registerForConference: ['getProfile', 'getConference', 'getConferencesToAttend',
+                'queryConferences', 'getConferencesCreated'],
+            unregisterFromConference: ['getProfile', 'getConference', 'getConferencesToAttend',
+                'queryConferences', 'getConferencesCreated']
+        }
+    };
+
+    var cache = {};
+    var inFlight = {};
+    var queue = [];
+    // bumped by invalidate()/clear(); responses to calls sent before are not cached
+    var generation = 0;
+    var invalidatedAt = {};
+    var clearedAt = 0;
+
+    var cacheKey = function (method, params) {
+        return method + ':' + JSON.stringify(params || {});
+    };
+
+    /**
+     * Gives a batch entry the same shape as the response passed to execute() callbacks.
+     */
+    var normalize = function (response) {
+        var body = (response && response.result) || {};
+        var resp = angular.extend({}, body);
+        resp.result = body;
+        if (body.error) {
+            resp.error = body.error;
+            resp.code = body.error.code || response.status;
+        }
+        return resp;
+    };
+
+    /**
+     * Callbacks call $scope.$apply, so they must never run inside a digest.
+     */
+    var deliver = function (callbacks, resp) {
+        window.setTimeout(function () {
+            angular.forEach(callbacks, function (callback) {
+                callback(resp);
+            });
+        }, 0);
+    };
+
+    var completed = function (call, resp) {
+        // calls that joined this one while it was on its way always get the response
+        var callbacks = inFlight[call.key] || [];
+        delete inFlight[call.key];
+        if (!resp.error) {
+            var obsolete = Math.max(invalidatedAt[call.method] || 0, clearedAt) > call.generation;
+            if (conferenceData.CACHE_TTL[call.method] && !obsolete) {
+                var previous = cache[call.key];
+                cache[call.key] = {resp: resp, fetched: Date.now()};
+                // only bother the page that revalidated again if the data actually changed
+                if (call.revalidate && !(previous && angular.equals(previous.resp.result, resp.result))) {
+                    callbacks = callbacks.concat(call.callbacks);
+                }
+            }
+            angular.forEach(conferenceData.INVALIDATES[call.method] || [], conferenceData.invalidate);
+        }
+        deliver(callbacks, resp);
+    };
+
+    var flush = function () {
+        var calls = queue;
+        queue = [];
+        if (calls.length == 1) {
+            var call = calls[0];
+            gapi.client.conference[call.method](call.params).execute(function (resp) {
+                completed(call, resp);
+            });
+            return;
+        }
+        var batch = gapi.client.newBatch();
+        angular.forEach(calls, function (call, i) {
+            batch.add(gapi.client.conference[call.method](call.params), {id: 'c' + i});
+        });
+        batch.execute(function (responses) {
+            angular.forEach(calls, function (call, i) {
+                completed(call, normalize(responses && responses['c' + i]));
+            });
+        });
+    };
+
+    var send = function (call) {
+        var alreadySent = call.key in inFlight;
+        inFlight[call.key] = inFlight[call.key] || [];
+        if (!call.revalidate) {
+            inFlight[call.key].push.apply(inFlight[call.key], call.callbacks);
+        }
+        if (alreadySent) {
+            return;     // an identical call is already on its way
+        }
+        call.generation = generation;
+        queue.push(call);
+        if (queue.length == 1) {
+            window.setTimeout(flush, 0);
+        }
+    };
+
+    /**
+     * Calls an API method like gapi.client.conference[method](params).execute(callback) would,
+     * answering read methods from the cache when possible.
+     *
+     * @param {string} method the API method name.
+     * @param {Object} params the request parameters.
+     * @param {Function} callback invoked with the response (twice if a stale response was revalidated
+     *     and changed).
+     */
+    conferenceData.execute = function (method, params, callback) {
+        var key = cacheKey(method, params);
+        var call = {method: method, params: params || {}, key: key, callbacks: callback ? [callback] : []};
+        var ttl = conferenceData.CACHE_TTL[method];
+        var entry = ttl && cache[key];
+        if (entry) {
+            var age = Date.now() - entry.fetched;
+            if (age < ttl * conferenceData.STALE_FACTOR) {
+                deliver(call.callbacks, entry.resp);
+                if (age >= ttl && !(key in inFlight)) {
+                    call.revalidate = true;
+                    send(call);
+                }
+                return;
+            }
+        }
+        send(call);
+    };
+
+    /**
+     * Warms the cache with several read calls, sent as one batch.
+     *
+     * @param {Array} calls [{method: ..., params: ...}]
+     */
+    conferenceData.prefetch = function (calls) {
+        angular.forEach(calls, function (call) {
+            conferenceData.execute(call.method, call.params);
+        });
+    };
+
+    /**
+     * Drops every cached response of a method.
+     */
+    conferenceData.invalidate = function (method) {
+        invalidatedAt[method] = ++generation;
+        angular.forEach(Object.keys(cache), function (key) {
+            if (key.indexOf(method + ':') == 0) {
+                delete cache[key];
+            }
+        });
+    };
+
+    /**
+     * Drops all cached responses, e.g. when the user signs out.
+     */
+    conferenceData.clear = function () {
+        clearedAt = ++generation;
+        cache = {};
+    };
+
+    return conferenceData;
+});
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+taskchain.py -- Udacity conference server-side Python App Engine
+    cursor-chained task runs checkpointed in a status entity
+
+Long jobs (migrations, the facet recount, seat reconciliation) walk a
+query one batch per task. Their status entity (a ChainStatus) holds the
+run id, the cursor of the next batch and the number of batches done.
+
+Each batch task is named after its run and batch number, so a task added
+twice is queued once. It also carries them as 'run' and 'batch' params.
+runBatch() turns away a task whose batch has already been recorded,
+e.g. a retry after the first try checkpointed; it re-chains the next
+batch instead, in case the first try died before queueing it.
+checkpoint() records a batch in a transaction, and only if the stored
+status still expects that batch, so no batch is counted twice.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from tenants import taskName
+
+
+def addNamedTask(url, name, params=None, countdown=0):
+    """Queue a task under name once; adding it again does nothing."""
+    try:
+        taskqueue.add(url=url, params=params, countdown=countdown,
+                      name=taskName(name))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def chainBatch(status, url, prefix, params=None, countdown=0):
+    """Queue the task for status's next batch."""
+    params = dict(params or {}, run=status.runId, batch=status.batches)
+    addNamedTask(url, '%s-%d-%d' % (prefix, status.runId, status.batches),
+                 params, countdown)
+
+
+def batchParams(request):
+    """Return a chained task's (run id, batch number)."""
+    return int(request.get('run')), int(request.get('batch'))
+
+
+def runBatch(status, run_id, batch, url, prefix, params=None):
+    """True if the task for (run_id, batch) should run its batch now."""
+    if status is None or status.runId != run_id or status.done:
+        return False
+    if status.batches != batch:
+        # an earlier try got as far as its checkpoint
+        chainBatch(status, url, prefix, params)
+        return False
+    return True
+
+
+def pageCursor(status):
+    """Return the Cursor where status's next batch starts, or None."""
+    return Cursor(urlsafe=status.cursor) if status.cursor else None
+
+
+def checkpoint(status, cursor, more, update=None, **counters):
+    """Record the batch run from status; return the saved copy, or None.
+
+    Runs in a transaction on a fresh copy of status, so anything other
+    writers stored meanwhile is kept. counters are added to the integer
+    properties of the same names; update(stored), if given, makes any
+    other changes. None means the run was restarted or the batch was
+    already recorded: nothing is saved and the chain must stop here.
+    """
+    run_id, batch = status.runId, status.batches
+
+    def save():
+        stored = status.key.get()
+        if stored is None or stored.runId != run_id or stored.batches != batch:
+            return None
+        for name, value in counters.iteritems():
+            setattr(stored, name, getattr(stored, name) + value)
+        stored.cursor = cursor.urlsafe() if (more and cursor) else None
+        stored.batches += 1
+        stored.done = not stored.cursor
+        if update:
+            update(stored)
+        stored.put()
+        return stored
+    return ndb.transaction(save)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+tenants.py -- Udacity conference server-side Python App Engine
+    tenant (event organisation) resolution for one shared deployment
+
+Each tenant's datastore entities and memcache keys live in a namespace
+named after it. A request's tenant comes from, in order:
+
+  - the X-AppEngine-Current-Namespace header taskqueue puts on tasks
+    added in a tenant's namespace (App Engine strips X-AppEngine-*
+    headers from outside requests, so it cannot be forged);
+  - its host: TENANT_HOSTS, or a <tenant>.<domain> subdomain;
+  - a /t/<tenant>/ path prefix, which tenant_path_middleware strips.
+
+With TENANTS empty everything runs in the default namespace as before.
+Cron requests arrive in the default namespace; cron handlers queue the
+same work for every tenant with forEachTenant().
+
+"""
+
+import re
+
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+
+# tenant names double as namespaces: [0-9A-Za-z._-]{1,100}
+TENANTS = ()
+TENANT_HOSTS = {}       # e.g. {'events.example.org': 'example'}
+TENANT_PATH_PREFIX = re.compile(r'^/t/([0-9A-Za-z._-]+)(/.*)$')
+TASK_NAMESPACE_HEADER = 'HTTP_X_APPENGINE_CURRENT_NAMESPACE'
+
+
+def tenantForEnviron(environ):
+    """Return the tenant (namespace) for a request, '' for the default."""
+    namespace = environ.get(TASK_NAMESPACE_HEADER)
+    if namespace in TENANTS:
+        return namespace
+    host = environ.get('HTTP_HOST', '').split(':')[0].lower()
+    if host in TENANT_HOSTS:
+        return TENANT_HOSTS[host]
+    if host.split('.')[0] in TENANTS:
+        return host.split('.')[0]
+    match = TENANT_PATH_PREFIX.match(environ.get('PATH_INFO', ''))
+    if match and match.group(1) in TENANTS:
+        return match.group(1)
+    return ''
+
+
+def currentTenant():
+    return namespace_manager.get_namespace()
+
+
+def taskName(name):
+    """Qualify a task name with the tenant; names are global per queue."""
+    tenant = re.sub(r'[^0-9A-Za-z_-]', '_', currentTenant())
+    return '%s--%s' % (tenant, name) if tenant else name
+
+
+def forEachTenant(url, method='GET', params=None):
+    """Queue a task to url in every tenant's namespace."""
+    previous = namespace_manager.get_namespace()
+    tasks = []
+    try:
+        for tenant in TENANTS:
+            # tasks record the namespace they are created in
+            namespace_manager.set_namespace(tenant)
+            tasks.append(taskqueue.Task(url=url, method=method,
+                                        params=params))
+    finally:
+        namespace_manager.set_namespace(previous)
+    # Queue.add takes at most 100 tasks per call
+    for i in range(0, len(tasks), 100):
+        taskqueue.Queue().add(tasks[i:i + 100])
+
+
+def tenant_path_middleware(app):
+    """Serve /t/<tenant>/... as ... in that tenant's namespace."""
+    def tenant_app(environ, start_response):
+        match = TENANT_PATH_PREFIX.match(environ.get('PATH_INFO', ''))
+        if match and match.group(1) in TENANTS:
+            namespace_manager.set_namespace(match.group(1))
+            # webapp2 routes on SCRIPT_NAME + PATH_INFO, so drop the prefix
+            environ['PATH_INFO'] = match.group(2)
+        return app(environ, start_response)
+    return tenant_app
@@ -4,7 +4,9 @@ import time
 import uuid
 
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
+from models import Tombstone
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -43,3 +45,38 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def deleteWithTombstones(keys):
+    """Delete entities, leaving Tombstones so getChangesSince reports them."""
+    ndb.put_multi([Tombstone(id=key.urlsafe(), kind=key.kind()) for key in keys])
+    ndb.delete_multi(keys)
+
+
+def withAncestors(keys):
+    """Return keys plus every ancestor of each, without duplicates."""
+    related = []
+    for key in keys:
+        while key is not None:
+            if key not in related:
+                related.append(key)
+            key = key.parent()
+    return related
+
+
+@ndb.tasklet
+def getRelatedAsync(*keys, **options):
+    """Fetch keys and all their ancestors in one batch.
+
+    A conference key brings its organizer's Profile, a session key its
+    Conference and Profile. Resolves to {key: entity or None}; options
+    (e.g. deadline) go to get_multi_async().
+    """
+    related = withAncestors(k for k in keys if k is not None)
+    entities = yield ndb.get_multi_async(related, **options)
+    raise ndb.Return(dict(zip(related, entities)))
+
+
+def getRelated(*keys, **options):
+    """Blocking getRelatedAsync()."""
+    return getRelatedAsync(*keys, **options).get_result()